@@ -0,0 +1,77 @@
+"""
+    Benchmark of get_spotify_track_data_from_file:
+    10k Last.fm tracks looked up in a file of 100k track uri codes.
+    The old nested loop is timed on a smaller sample and extrapolated,
+    the full size would take hours.
+
+    Run from the root folder: python -m benchmarks.track_uri_index
+"""
+
+import os
+import json
+import time
+import random
+import tempfile
+
+os.environ.setdefault("SPOTIPY_CLIENT_ID", "benchmark")
+os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "benchmark")
+
+import pandas as pd
+
+from utils.data_processing import analyze_data
+
+LASTFM_TRACKS = 10_000
+FILE_TRACKS = 100_000
+OLD_SAMPLE = 100
+
+def nested_loop_lookup(lastfm_data: pd.DataFrame, tracks_uris: list[dict]) -> pd.DataFrame:
+    "The lookup before the index - kept here for comparison."
+    needed_uris = [
+        (entry["name"], entry["artist"], entry["uri"])
+        for _, row in lastfm_data.iterrows()
+        for entry in tracks_uris
+        if entry["name"].lower() == row["name"].lower()
+        and entry["artist"].lower() == row["artist"].lower()
+    ]
+
+    return pd.DataFrame(needed_uris)
+
+def main():
+    random.seed(0)
+    tracks_uris = [
+        {"name": f"Track {i}", "artist": f"Artist {i % 5000}", "uri": f"spotify:track:{i}"}
+        for i in range(FILE_TRACKS)
+    ]
+    sample = random.sample(tracks_uris, LASTFM_TRACKS)
+    lastfm_data = pd.DataFrame({
+        "name": [entry["name"].upper() for entry in sample],
+        "artist": [entry["artist"] for entry in sample]
+    })
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "all_tracks_uris.json")
+
+        with open(path, "w", encoding="utf-8") as fd:
+            json.dump(tracks_uris, fd)
+
+        start = time.perf_counter()
+        found = analyze_data.get_spotify_track_data_from_file(lastfm_data, path)
+        first_call = time.perf_counter() - start
+
+        start = time.perf_counter()
+        analyze_data.get_spotify_track_data_from_file(lastfm_data, path)
+        cached_call = time.perf_counter() - start
+
+    start = time.perf_counter()
+    nested_loop_lookup(lastfm_data.head(OLD_SAMPLE), tracks_uris)
+    old_sample = time.perf_counter() - start
+    old_estimate = old_sample * LASTFM_TRACKS / OLD_SAMPLE
+
+    print(f"{LASTFM_TRACKS} x {FILE_TRACKS}, {len(found)} tracks found")
+    print(f"index, first call (reads the file): {first_call:.3f} s")
+    print(f"index, later calls:                 {cached_call:.3f} s")
+    print(f"nested loop, {OLD_SAMPLE} tracks:           {old_sample:.2f} s")
+    print(f"nested loop, estimated for all:     {old_estimate:.0f} s")
+
+if __name__ == "__main__":
+    main()
@@ -7,17 +7,20 @@
     - see_more - extended view of tables
     - validate_files - check uploaded json files
     - spotify_analysis - uses the Spotify Extended Listening data
+    - job_progress, finish_job - the state of an analysis running in the background
+    - show_analysis - the tables and graphs of a finished analysis
 """
 
 import os
-from datetime import date
 
-from flask import Flask, render_template, url_for, request, redirect, session
+from flask import Flask, render_template, url_for, request, redirect, session, flash, jsonify
 from flask_session.__init__ import Session #type: ignore
 
-from utils import validation
-from utils.lastfm import get_data, lastfm_validation
-from utils.data_processing import visualize_data, extended_history
+from utils import validation, analysis, upload_store
+from utils.jobs import job_runner, RedisJobQueue
+from utils.result_store import result_store
+from utils.lastfm import lastfm_validation
+from utils.data_processing import visualize_data, tables
 
 app = Flask(__name__)
 
@@ -32,6 +35,16 @@ app.config["SESSION_PERMANENT"] = False
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
 Session(app)
+job_runner.init_app(app)
+
+@app.cli.command("jobs-worker")
+def jobs_worker():
+    "Run the analyses queued in Redis (JOB_BACKEND=redis)."
+    if not isinstance(job_runner, RedisJobQueue):
+        print("The jobs run inside the web server, set JOB_BACKEND=redis to use workers.")
+        return
+
+    job_runner.work()
 
 @app.route("/")
 def main_page():
@@ -92,53 +105,7 @@ def lastfm_analysis_predefined(username: str, time_period: str):
     ):
         return redirect(url_for("main_page"))
 
-    graphs = {}
-    full_tables = {}
-    short_tables = {}
-    top_data = {}
-
-    for data_type in ["tracks", "albums", "artists"]:
-        top_data[data_type] = get_data.top_data_predefined_period(username, data_type, time_period)
-
-        if not validation.non_empty_dataframe(top_data[data_type]):
-            break
-
-        full_tables[data_type] = visualize_data.get_html_table(top_data[data_type])
-        short_tables[data_type] = visualize_data.get_html_table(top_data[data_type], 15)
-
-        chart = visualize_data.get_top_scrobbles_chart(data_type, top_data[data_type], False)
-
-        if chart:
-            script, div = chart
-
-            graphs[data_type] = {
-                "script": script,
-                "div": div
-            }
-
-    overall_stats = visualize_data.get_total_stats_from_lastfm(
-        username,
-        top_data,
-        time_period
-    )
-    overall_stats_html = visualize_data.get_html_table(overall_stats)
-
-    similar_artists = get_data.all_similar_artists(top_data["artists"]["name"])
-    similar_artists = similar_artists.head(10)
-    similar_artists_dict = similar_artists.to_dict(orient="records")
-
-    session["graphs"] = graphs
-    session["full_tables"] = full_tables
-    session["short_tables"] = short_tables
-    session["overall_stats"] = overall_stats_html
-
-    return render_template(
-        "lastfm_analysis.html",
-        title=f"{username} Track Analysis",
-        username=username,
-        time_period=time_period,
-        similar_artists=similar_artists_dict
-    )
+    return run_cached_analysis("lastfm_predefined", username, time_period)
 
 @app.route("/lastfm_analysis/<username>/custom")
 def lastfm_analysis_custom(username):
@@ -161,102 +128,128 @@ def lastfm_analysis_custom(username):
     ):
         return redirect(url_for("main_page"))
 
-    custom_data = get_data.recent_tracks_by_custom_dates(username, start_date, end_date)
+    return run_cached_analysis("lastfm_custom", username, start_date, end_date)
+
+def run_cached_analysis(task_name: str, username: str, *period: str):
+    """Show the saved analysis of a user and a time period right away
+    and refresh it in the background if it is stale.
+    Without a saved analysis show the loading page of a new job.
+    Concurrent requests for the same analysis share one job.
+    """
+
+    analysis_id = analysis.cached_analysis_id(task_name, username, *period)
+    result = result_store.load(analysis_id)
+
+    if result and not analysis.is_stale(result):
+        return redirect(url_for("show_analysis", analysis_id=analysis_id))
+
+    job_id = job_runner.submit(task_name, username, *period, analysis_id, key=analysis_id)
+
+    if result:
+        return redirect(url_for("show_analysis", analysis_id=analysis_id))
+
+    return render_template("loading.html", job_id=job_id, username=username)
+
+@app.route("/progress/<job_id>")
+def job_progress(job_id):
+    "The state of a background analysis as json for the loading page."
 
-    if not validation.non_empty_dataframe(custom_data):
+    state = job_runner.status(job_id)
+
+    if state is None:
+        return jsonify({"status": "missing"}), 404
+
+    return jsonify({
+        key: state[key]
+        for key in ["status", "progress", "stage", "current_page", "total_pages"]
+    })
+
+@app.route("/job/<job_id>")
+def finish_job(job_id):
+    "Show the messages of a finished analysis and go to its result."
+
+    state = job_runner.status(job_id)
+
+    if state is None or state["status"] == "running":
         return redirect(url_for("main_page"))
 
-    graphs = {}
-    full_tables = {}
-    short_tables = {}
-    grouped_data = {}
-    custom_graphs = {}
-
-    for data_type in ["tracks", "albums", "artists"]:
-        match data_type:
-            case "artists":
-                grouped_data[data_type] = custom_data.groupby("artist", as_index=False).size()
-            case "albums" | "tracks":
-                grouped_data[data_type] = custom_data.groupby(
-                    [data_type[:-1], "artist"],
-                    as_index=False
-                ).size()
-
-        grouped_data[data_type].rename(columns={"size": "scrobble count"}, inplace=True)
-        grouped_data[data_type].sort_values(
-            "scrobble count",
-            ascending=False,
-            inplace=True,
-            ignore_index=True
-            )
-        grouped_data[data_type].index += 1
-
-        full_tables[data_type] = visualize_data.get_html_table(grouped_data[data_type])
-        short_tables[data_type] = visualize_data.get_html_table(grouped_data[data_type], 15)
-
-        script, div = visualize_data.get_top_scrobbles_chart(
-            data_type,
-            grouped_data[data_type],
-            True
-            )
-
-        graphs[data_type] = {
-            "script": script,
-            "div": div
-        }
-
-    script, div = visualize_data.get_cumulative_scrobble_stats(
-        custom_data,
-        date.fromisoformat(start_date),
-        date.fromisoformat(end_date)
-        )
-    custom_graphs["cumulative"] = {
-        "script": script,
-        "div": div
-    }
-
-    overall_stats = visualize_data.get_total_stats_from_lastfm(
-        username,
-        grouped_data,
-        start_date=date.fromisoformat(start_date),
-        end_date=date.fromisoformat(end_date)
-        )
-    overall_stats_html = visualize_data.get_html_table(overall_stats)
+    for message in state["messages"]:
+        flash(message)
+
+    if not state["analysis_id"]:
+        return redirect(url_for("main_page"))
+
+    return redirect(url_for("show_analysis", analysis_id=state["analysis_id"]))
+
+@app.route("/analysis/<analysis_id>")
+def show_analysis(analysis_id):
+    "Render the tables and graphs of a saved analysis."
+
+    result = result_store.load(analysis_id)
 
-    similar_artists_dict = get_data.all_similar_artists(grouped_data["artists"]["artist"]) \
-    .head(10) \
-    .to_dict(orient="records")
+    if not result:
+        flash("The analysis has expired, please run it again!")
+        return redirect(url_for("main_page"))
 
-    session["graphs"] = graphs
-    session["full_tables"] = full_tables
-    session["short_tables"] = short_tables
-    session["custom_graphs"] = custom_graphs
-    session["overall_stats"] = overall_stats_html
+    session["analysis_id"] = analysis_id
 
     return render_template(
-        "lastfm_analysis_custom.html",
-        title=f"{username} Track Analysis",
-        username=username,
-        start_date=start_date,
-        end_date=end_date,
-        time_period=request.args.get("time_period"),
-        similar_artists=similar_artists_dict
+        result["template"],
+        **result["template_args"],
+        **visualize_data.get_analysis_views(result)
     )
 
-@app.route("/lastfm_analysis/<username>/<time_period>/<data_type>")
-def see_more(username, time_period, data_type):
-    "visualize the whole table"
-    title = request.args.get("prev_title")
-    full_table = session.get("full_tables", {}).get(data_type)
+def render_table_page(data_type: str, **template_args):
+    """Render one page of a top table of the analysis in the session.
+    The page, the column to sort by and the order come from the query string."""
+
+    result = result_store.load(session.get("analysis_id"))
+
+    if not validation.check_data_type(data_type) or not result or data_type not in result["tables"]:
+        return redirect(url_for("main_page"))
+
+    table = tables.table_from_lists(result["tables"][data_type])
+    sort_by = request.args.get("sort")
+    descending = request.args.get("order", "desc") != "asc"
+
+    page_table, page, pages = tables.table_page(
+        table,
+        request.args.get("page", 1, type=int),
+        sort_by,
+        descending
+    )
+
+    def page_url(**changes) -> str:
+        "The url of this view with some query parameters changed."
+        return url_for(
+            request.endpoint,
+            **(request.view_args or {}),
+            **{**request.args.to_dict(), **changes}
+        )
 
     return render_template(
         "see_more.html",
+        data_type=data_type,
+        page_table=visualize_data.get_html_table(page_table),
+        columns=list(table.columns),
+        sort_by=sort_by if sort_by in table.columns else None,
+        descending=descending,
+        page=page,
+        pages=pages,
+        page_url=page_url,
+        title=f"Full {data_type} table view",
+        **template_args
+    )
+
+@app.route("/lastfm_analysis/<username>/<time_period>/<data_type>")
+def see_more(username, time_period, data_type):
+    "visualize the whole table one page at a time"
+
+    return render_table_page(
+        data_type,
         username=username,
         time_period=time_period,
-        prev_title=title,
-        data_type=data_type,
-        full_table=full_table,
-        title=f"Full {data_type} table view"
+        prev_title=request.args.get("prev_title")
     )
 
 @app.route("/spotify_analysis", methods=["POST"])
@@ -270,97 +263,19 @@ def spotify_analysis():
     files = request.files.getlist("file")
 
     for file in files:
-        if not validation.is_file_extension_json(file.filename):
+        if not validation.is_history_file_extension(file.filename):
             return redirect(url_for("main_page"))
 
-    all_dataframes = extended_history.parse_file_data(files)
-
-    graphs = {}
-    full_tables = {}
-    short_tables = {}
-    grouped_data = {}
-    custom_graphs = {}
-
-    for data_type in ["tracks", "albums", "artists"]:
-        match data_type:
-            case "artists":
-                grouped_data[data_type] = all_dataframes.groupby("artist", as_index=False).size()
-            case "albums" | "tracks":
-                grouped_data[data_type] = all_dataframes.groupby(
-                    [data_type[:-1], "artist"],
-                    as_index=False
-                ).size()
-
-        grouped_data[data_type].rename(columns={"size": "scrobble count"}, inplace=True)
-        grouped_data[data_type].sort_values(
-            "scrobble count",
-            ascending=False,
-            inplace=True,
-            ignore_index=True
-            )
-        grouped_data[data_type].index += 1
-
-        full_tables[data_type] = visualize_data.get_html_table(grouped_data[data_type])
-        short_tables[data_type] = visualize_data.get_html_table(grouped_data[data_type], 15)
-
-        script, div = visualize_data.get_top_scrobbles_chart(
-            data_type,
-            grouped_data[data_type],
-            True
-            )
-
-        graphs[data_type] = {
-            "script": script,
-            "div": div
-        }
-
-    print(all_dataframes.iloc[0]["scrobble_time"].date())
-    script, div = visualize_data.get_cumulative_scrobble_stats(
-        all_dataframes,
-        all_dataframes["scrobble_time"].min().date(),
-        all_dataframes["scrobble_time"].max().date()
-        )
-    custom_graphs["cumulative"] = {
-        "script": script,
-        "div": div
-    }
-
-    overall_stats = visualize_data.get_total_stats_from_lastfm(
-        "",
-        grouped_data,
-        start_date=all_dataframes["scrobble_time"].min().date(),
-        end_date=all_dataframes["scrobble_time"].max().date()
-        )
-    overall_stats_html = visualize_data.get_html_table(overall_stats)
-
-    similar_artists_dict = get_data.all_similar_artists(grouped_data["artists"]["artist"]) \
-    .head(10) \
-    .to_dict(orient="records")
-
-    session["graphs"] = graphs
-    session["full_tables"] = full_tables
-    session["short_tables"] = short_tables
-    session["custom_graphs"] = custom_graphs
-    session["overall_stats"] = overall_stats_html
-
-    return render_template("spotify_analysis.html",
-        start_date=all_dataframes["scrobble_time"].min().date(),
-        end_date=all_dataframes["scrobble_time"].max().date(),
-        similar_artists=similar_artists_dict
-        )
+    # the uploads are closed when the request ends, the job gets their saved copies
+    job_id = job_runner.submit("spotify", upload_store.save_uploads(files))
+
+    return render_template("loading.html", job_id=job_id)
 
 @app.route("/spotify_analysis/<data_type>")
 def see_more_spotify(data_type):
-    "visualize the whole table"
-
-    full_table = session.get("full_tables", {}).get(data_type)
+    "visualize the whole table one page at a time"
 
-    return render_template(
-        "see_more.html",
-        data_type=data_type,
-        full_table=full_table,
-        title=f"Full {data_type} table view"
-    )
+    return render_table_page(data_type)
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,64 @@
+import json
+from unittest.mock import patch
+
+import requests
+
+from utils.cache import LRUCache
+from utils.lastfm.client import LastfmClient, cache_ttl, LIVE_PAGE_TTL, CACHE_TTL
+
+def json_response(data: dict) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(data).encode()
+
+    return response
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=10)
+    cache.set("a", b"aaaa", 60)
+    cache.set("b", b"bbbb", 60)
+    cache.get("a")
+    cache.set("c", b"cccc", 60)
+
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("b") is None
+    assert cache.get("c") == b"cccc"
+    assert cache.current_bytes == 8
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(max_bytes=10)
+    cache.set("a", b"a", -1)
+
+    assert cache.get("a") is None
+    assert cache.current_bytes == 0
+
+def test_client_serves_repeated_calls_from_cache():
+    client = LastfmClient("key", cache=LRUCache(max_bytes=1024))
+    similar = {"similarartists": {"artist": []}}
+
+    with patch.object(client.session, "get", return_value=json_response(similar)) as get:
+        first = client.get("artist.getSimilar", {"artist": "Björk"})
+        second = client.get("artist.getSimilar", {"artist": "Björk"})
+        client.get("artist.getSimilar", {"artist": "Portishead"})
+
+    assert get.call_count == 2
+    assert first.json() == second.json() == similar
+    assert second.ok
+
+def test_client_does_not_cache_errors():
+    client = LastfmClient("key", cache=LRUCache(max_bytes=1024))
+    error = {"error": 6, "message": "User not found"}
+
+    with patch.object(client.session, "get", return_value=json_response(error)) as get:
+        client.get("user.getinfo", {"user": "nobody"})
+        client.get("user.getinfo", {"user": "nobody"})
+
+    assert get.call_count == 2
+
+def test_now_playing_pages_are_cached_briefly():
+    now_playing = {"recenttracks": {"track": [{"@attr": {"nowplaying": "true"}}]}}
+    old_page = {"recenttracks": {"track": [{"date": {"uts": "10"}}]}}
+
+    assert cache_ttl("user.getrecenttracks", {"to": 100}, now_playing) == LIVE_PAGE_TTL
+    assert cache_ttl("user.getrecenttracks", {"to": 100}, old_page) \
+        == CACHE_TTL["user.getrecenttracks"]
@@ -0,0 +1,370 @@
+import io
+import os
+import json
+import time
+import zipfile
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from unittest.mock import patch
+
+import pytest
+import msgspec
+import pandas as pd
+from werkzeug.datastructures import FileStorage
+
+os.environ.setdefault("SPOTIPY_CLIENT_ID", "test-client-id")
+os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "test-client-secret")
+
+from utils.data_processing import aggregate, analyze_data, dtypes, extended_history, parse_cache, visualize_data
+
+@pytest.fixture(autouse=True)
+def parse_cache_dir(tmp_path):
+    with patch.object(parse_cache, "CACHE_DIR", str(tmp_path / "parse_cache")):
+        yield tmp_path / "parse_cache"
+
+def test_track_data_from_file_matches_case_insensitively(tmp_path):
+    path = tmp_path / "all_tracks_uris.json"
+    path.write_text(json.dumps([
+        {"name": "Teardrop", "artist": "Massive Attack", "uri": "spotify:track:1"},
+        {"name": "Roads", "artist": "Portishead", "uri": "spotify:track:2"}
+    ]), encoding="utf-8")
+
+    lastfm_data = pd.DataFrame({
+        "name": ["roads", "Unknown", "TEARDROP"],
+        "artist": ["portishead", "Nobody", "massive attack"]
+    })
+
+    found = analyze_data.get_spotify_track_data_from_file(lastfm_data, str(path))
+
+    assert found.to_dict(orient="records") == [
+        {"name": "Roads", "artist": "Portishead", "uri": "spotify:track:2"},
+        {"name": "Teardrop", "artist": "Massive Attack", "uri": "spotify:track:1"}
+    ]
+
+def test_track_uri_index_reads_list_entries(tmp_path):
+    path = tmp_path / "all_tracks_uris.json"
+    path.write_text(json.dumps([["Glory Box", "Portishead", "spotify:track:3"]]), encoding="utf-8")
+
+    index = analyze_data.get_track_uri_index(str(path))
+
+    assert list(index["uri"]) == ["spotify:track:3"]
+    assert list(index["name_key"]) == ["glory box"]
+
+def test_parse_file_data_filters_short_streams():
+    history = [
+        {
+            "ts": "2024-03-01T10:00:00Z",
+            "platform": "android",
+            "ms_played": 185000,
+            "master_metadata_track_name": "Teardrop",
+            "master_metadata_album_artist_name": "Massive Attack",
+            "master_metadata_album_album_name": "Mezzanine",
+            "spotify_track_uri": "spotify:track:1",
+            "reason_end": "trackdone",
+            "skipped": False
+        },
+        {
+            "ts": "2024-03-01T10:04:00Z",
+            "ms_played": 29999,
+            "master_metadata_track_name": "Roads",
+            "master_metadata_album_artist_name": "Portishead",
+            "master_metadata_album_album_name": "Dummy",
+            "spotify_track_uri": "spotify:track:2",
+            "reason_end": "fwdbtn",
+            "skipped": True
+        },
+        {
+            "ts": "2024-03-01T10:05:00Z",
+            "ms_played": 30000,
+            "master_metadata_track_name": None,
+            "master_metadata_album_artist_name": None,
+            "master_metadata_album_album_name": None,
+            "spotify_track_uri": None,
+            "reason_end": "endplay",
+            "skipped": None
+        }
+    ]
+
+    streams = extended_history.parse_file_data([io.BytesIO(json.dumps(history).encode())])
+
+    assert list(streams.columns) == [
+        "track", "artist", "album", "seconds_played",
+        "scrobble_time", "reason_end", "skipped", "track_uri"
+    ]
+    assert list(streams["seconds_played"]) == [185.0, 30.0]
+    assert streams["track"].tolist()[0] == "Teardrop"
+    assert streams["track"].isna().tolist() == [False, True]
+    assert streams["scrobble_time"].iloc[0] == pd.Timestamp("2024-03-01T10:00:00Z")
+
+    assert streams["track"].dtype == "category"
+    assert streams["skipped"].dtype == "boolean"
+    assert streams["seconds_played"].dtype == "float32"
+    assert streams["scrobble_time"].dtype == "datetime64[s, UTC]"
+
+@pytest.mark.parametrize("chunk_bytes", [1, 7, 64, 1024])
+def test_streaming_parse_matches_whole_file_parse(chunk_bytes):
+    history = [
+        {
+            "ts": f"2024-03-01T10:{minute:02d}:00Z",
+            "ms_played": 60000 + minute,
+            "master_metadata_track_name": f"Song {{part {minute}}}, \"live\\\" [{minute}]",
+            "master_metadata_album_artist_name": "Artist",
+            "master_metadata_album_album_name": "Album",
+            "spotify_track_uri": f"spotify:track:{minute}",
+            "reason_end": "trackdone",
+            "skipped": False
+        }
+        for minute in range(20)
+    ]
+    data = json.dumps(history, indent=2).encode()
+
+    whole = extended_history.parse_file(io.BytesIO(data), chunk_bytes=None)
+    streamed = extended_history.parse_file(io.BytesIO(data), chunk_bytes=chunk_bytes)
+
+    pd.testing.assert_frame_equal(whole, streamed)
+    assert len(streamed) == 20
+
+@pytest.mark.parametrize("chunk_bytes", [64, 1024])
+def test_streaming_parse_of_malformed_history_fails_fast(chunk_bytes):
+    history = [
+        {"ts": f"2024-03-01T10:{minute:02d}:00Z", "ms_played": 60000, "master_metadata_track_name": f"Song {minute}"}
+        for minute in range(200)
+    ]
+    # one quote less makes every later brace look like it is inside a string
+    data = json.dumps(history).replace('"Song 20"', 'Song 20"').encode()
+    history_file = io.BytesIO(data)
+
+    with pytest.raises(msgspec.DecodeError) as whole_file_error:
+        msgspec.json.decode(data)
+
+    offset = whole_file_error.value.args[0].split("(byte ")[1].rstrip(")")
+
+    with patch.object(extended_history, "MAX_STREAM_BYTES", 256), \
+        pytest.raises(msgspec.DecodeError, match=f"malformed near byte {offset}:"):
+        extended_history.parse_file(history_file, chunk_bytes=chunk_bytes)
+
+    assert history_file.tell() < len(data)
+
+def test_streaming_parse_of_empty_history():
+    streams = extended_history.parse_file(io.BytesIO(b" [ ] "), chunk_bytes=2)
+
+    assert streams.empty
+    assert "scrobble_time" in streams.columns
+
+def test_parse_file_data_in_worker_processes_orders_by_time(tmp_path):
+    files = [
+        json.dumps([
+            {
+                "ts": f"2024-03-{day:02d}T10:00:00Z",
+                "ms_played": 60000,
+                "master_metadata_track_name": f"Song {day}",
+                "master_metadata_album_artist_name": "Artist",
+                "master_metadata_album_album_name": "Album",
+                "spotify_track_uri": f"spotify:track:{day}"
+            }
+            for day in days
+        ]).encode()
+        for days in [(5, 6), (1, 2, 3), (4,)]
+    ]
+
+    sequential = extended_history.parse_file_data([io.BytesIO(data) for data in files], workers=1)
+    parallel = extended_history.parse_file_data([io.BytesIO(data) for data in files], workers=2)
+
+    for index, data in enumerate(files):
+        (tmp_path / f"{index}.json").write_bytes(data)
+
+    # files on the disk are read by the workers
+    with ExitStack() as stack:
+        from_disk = extended_history.parse_file_data([
+            stack.enter_context(open(tmp_path / f"{index}.json", "rb"))
+            for index in range(len(files))
+        ], workers=2)
+
+    pd.testing.assert_frame_equal(sequential, parallel)
+    pd.testing.assert_frame_equal(sequential, from_disk)
+    assert list(parallel["track"]) == [f"Song {day}" for day in range(1, 7)]
+    assert isinstance(parallel["track"].dtype, pd.CategoricalDtype)
+
+def test_parse_json_files_submits_one_file_per_worker_at_a_time():
+    finished = []
+    # number of finished files whenever a file is read
+    read_after = []
+
+    class UploadedFile(io.BytesIO):
+        def read(self, *args):
+            read_after.append(len(finished))
+            return super().read(*args)
+
+    def parse_file_bytes(data, chunk_bytes):
+        time.sleep(0.01)
+        finished.append(data)
+        return pd.DataFrame()
+
+    with ThreadPoolExecutor(max_workers=1) as pool, \
+        patch.object(extended_history, "get_parse_pool", return_value=pool), \
+        patch.object(extended_history, "parse_file_bytes", side_effect=parse_file_bytes):
+        extended_history.parse_json_files([UploadedFile(b"[]") for _ in range(6)], None, workers=2)
+
+    assert len(finished) == 6
+    assert all(finished_files >= index - 2 for index, finished_files in enumerate(read_after))
+
+def test_parse_file_data_reads_audio_history_from_export_zip():
+    def history(day: int) -> str:
+        return json.dumps([{
+            "ts": f"2024-03-{day:02d}T10:00:00Z",
+            "ms_played": 60000,
+            "master_metadata_track_name": f"Song {day}",
+            "master_metadata_album_artist_name": "Artist",
+            "master_metadata_album_album_name": "Album",
+            "spotify_track_uri": f"spotify:track:{day}"
+        }])
+
+    archive = io.BytesIO()
+
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as export:
+        export.writestr("Spotify Extended Streaming History/Streaming_History_Audio_2024_1.json", history(2))
+        export.writestr("Spotify Extended Streaming History/Streaming_History_Audio_2023.json", history(1))
+        export.writestr("Spotify Extended Streaming History/Streaming_History_Video_2024.json", history(3))
+        export.writestr("Spotify Extended Streaming History/ReadMeFirst_ExtendedStreamingHistory.pdf", "")
+
+    archive.seek(0)
+    uploads = [
+        FileStorage(archive, filename="my_spotify_data.zip"),
+        FileStorage(io.BytesIO(history(4).encode()), filename="Streaming_History_Audio_2025.json")
+    ]
+
+    streams = extended_history.parse_file_data(uploads, workers=1)
+
+    assert list(streams["track"]) == ["Song 1", "Song 2", "Song 4"]
+
+def history_with_missing_values() -> bytes:
+    return json.dumps([
+        {
+            "ts": "2024-03-01T10:00:00Z",
+            "ms_played": 60000,
+            "master_metadata_track_name": "Song",
+            "master_metadata_album_artist_name": "Artist",
+            "master_metadata_album_album_name": "Album",
+            "reason_end": "trackdone",
+            "skipped": False,
+            "spotify_track_uri": "spotify:track:1"
+        },
+        {"ts": "2024-03-01T09:00:00.5Z", "ms_played": 45500, "skipped": None},
+        {"ts": "2024-03-02T10:00:00Z", "ms_played": 31000, "master_metadata_track_name": "Song",
+         "master_metadata_album_artist_name": "Artist", "skipped": True}
+    ]).encode()
+
+def test_parse_cache_loads_the_same_dataframe_without_parsing():
+    data = history_with_missing_values()
+
+    parsed = extended_history.parse_file_data([io.BytesIO(data)], workers=1)
+
+    with patch.object(extended_history, "parse_file", side_effect=AssertionError):
+        cached = extended_history.parse_file_data([io.BytesIO(data)], workers=1)
+
+    pd.testing.assert_frame_equal(parsed, cached)
+    assert cached["skipped"].isna().tolist() == [True, False, False]
+
+    # the saved text columns are loaded as categoricals, not as strings
+    loaded = parse_cache.load(parse_cache.content_hash(io.BytesIO(data)))
+
+    assert isinstance(loaded["track"].dtype, pd.CategoricalDtype)
+    assert loaded["seconds_played"].dtype == "float32"
+
+def test_parse_cache_evicts_least_recently_used_entries(parse_cache_dir):
+    first, second = io.BytesIO(history_with_missing_values()), io.BytesIO(b"[]")
+    first_key, second_key = parse_cache.content_hash(first), parse_cache.content_hash(second)
+
+    extended_history.parse_file_data([first, second], workers=1)
+    os.utime(parse_cache_dir / first_key, (0, 0))
+    parse_cache.evict(parse_cache.entry_size(str(parse_cache_dir / second_key)))
+
+    assert sorted(os.listdir(parse_cache_dir)) == [second_key]
+
+def test_top_chart_of_compact_history():
+    history = dtypes.compact_history(pd.DataFrame({
+        "track": ["Roads", "Roads", "Teardrop", "Glory Box"],
+        "artist": ["Portishead", "Portishead", "Massive Attack", "Portishead"],
+        "album": ["Dummy", "Dummy", "Mezzanine", "Dummy"],
+        "scrobble_time": pd.to_datetime([1, 2, 3, 4], unit="D")
+    }))
+
+    top_tracks = history.groupby(["track", "artist"], as_index=False, observed=True).size() \
+        .rename(columns={"size": "scrobble count"}) \
+        .sort_values("scrobble count", ascending=False)
+
+    assert top_tracks["scrobble count"].tolist() == [2, 1, 1]
+    assert visualize_data.get_top_scrobbles_chart("tracks", top_tracks, True, 3) is not None
+
+def test_parse_file_data_drops_streams_of_overlapping_exports():
+    def history(days) -> bytes:
+        return json.dumps([
+            {
+                "ts": f"2024-03-{day:02d}T10:00:00Z",
+                "ms_played": 60000,
+                "master_metadata_track_name": "Song",
+                "master_metadata_album_artist_name": "Artist",
+                "spotify_track_uri": "spotify:track:1"
+            }
+            for day in days
+        ]).encode()
+
+    # day 1 is twice in the older export, repeats inside one file are kept
+    older, newer = io.BytesIO(history([1, 1, 2, 3])), io.BytesIO(history([2, 3, 4, 4]))
+
+    streams = extended_history.parse_file_data([older, newer], workers=1)
+
+    assert streams["scrobble_time"].dt.day.tolist() == [1, 1, 2, 3, 4, 4]
+    assert streams.attrs["duplicate_streams"] == 2
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_top_counts_match_groupby(compact):
+    history = pd.DataFrame({
+        "track": ["Roads", "Roads", "Roads", "Teardrop", "Angel", None, "Roads"],
+        "album": ["Dummy", "Dummy", None, "Mezzanine", "Mezzanine", "Dummy", "Roseland NYC Live"],
+        "artist": ["Portishead", "Portishead", "Portishead", "Massive Attack",
+                   "Massive Attack", "Portishead", "Portishead"]
+    })
+
+    if compact:
+        history = dtypes.compact_history(history)
+
+    tables = aggregate.top_counts(history)
+
+    for data_type, columns in aggregate.DATA_TYPE_COLUMNS.items():
+        expected = history.groupby(columns, observed=True).size()
+        counted = tables[data_type].set_index(columns)["scrobble count"]
+
+        assert counted.is_monotonic_decreasing
+        assert tables[data_type].index[0] == 1
+        assert counted.sort_index().to_dict() == expected.sort_index().to_dict()
+
+    assert tables["tracks"].iloc[0].tolist() == ["Roads", "Portishead", 4]
+    assert tables["albums"].iloc[0].tolist() == ["Dummy", "Portishead", 3]
+
+def test_cumulative_counts_per_week_does_not_change_history():
+    history = dtypes.compact_history(pd.DataFrame({
+        "track": ["Roads", "Roads", "Teardrop", "Roads", "Angel"],
+        "album": ["Dummy", "Dummy", "Mezzanine", "Dummy", None],
+        "artist": ["Portishead", "Portishead", "Massive Attack", "Portishead", "Massive Attack"],
+        # Sunday, Monday, Tuesday, Wednesday of the next week, Monday two weeks later
+        "scrobble_time": pd.to_datetime(
+            ["2024-03-03 23:00", "2024-03-04 01:00", "2024-03-05 12:00", "2024-03-13 12:00", "2024-03-18 12:00"],
+            utc=True
+        )
+    }))
+    columns = list(history.columns)
+
+    cumulative = aggregate.cumulative_counts(history, "W")
+
+    assert list(history.columns) == columns
+    assert list(cumulative.index.strftime("%Y-%m-%d")) == ["2024-02-26", "2024-03-04", "2024-03-11", "2024-03-18"]
+    assert cumulative["track"].tolist() == [1, 3, 4, 5]
+    assert cumulative["artist"].tolist() == [1, 3, 4, 5]
+    assert cumulative["album"].tolist() == [1, 3, 4, 4]
+
+def test_adaptive_bucket_follows_the_length_of_the_period():
+    assert aggregate.adaptive_bucket(date(2024, 3, 1), date(2024, 3, 16)) == "D"
+    assert aggregate.adaptive_bucket(date(2024, 3, 1), date(2024, 4, 1)) == "W"
+    assert aggregate.adaptive_bucket(date(2024, 3, 1), date(2024, 4, 2)) == "M"
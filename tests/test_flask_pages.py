@@ -1,11 +1,49 @@
+import io
+import os
+import re
+import json
+import threading
+from datetime import date, timedelta
+from unittest.mock import patch
+
 import pytest
+import pandas as pd
+
+os.environ.setdefault("SPOTIPY_CLIENT_ID", "test-client-id")
+os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "test-client-secret")
+
+import main
 from main import app
+from flask_session import Session
+from utils import analysis, jobs, upload_store
+from utils.jobs import LocalJobRunner
+from utils.result_store import FileResultStore
+from utils.data_processing import tables, parse_cache
+
+@pytest.fixture
+def store(tmp_path):
+    store = FileResultStore(str(tmp_path / "results"), 1024 * 1024, 60)
+
+    with patch.object(main, "result_store", store), patch.object(analysis, "result_store", store):
+        yield store
 
 @pytest.fixture
-def client():
+def runner():
+    runner = LocalJobRunner(1, 60)
+    runner.init_app(app)
+
+    with patch.object(main, "job_runner", runner):
+        yield runner
+
+@pytest.fixture
+def client(store, runner, tmp_path):
     app.testing = True
-    with app.test_client() as client:
-        yield client
+
+    # sessions of the tests are saved in a temporary folder
+    with patch.dict(app.config, {"SESSION_FILE_DIR": str(tmp_path / "flask_session")}):
+        with patch.object(app, "session_interface", Session()._get_interface(app)), \
+            app.test_client() as client:
+            yield client
 
 def test_homepage(client):
     response = client.get("/")
@@ -13,3 +51,148 @@ def test_homepage(client):
     assert response.status_code == 200
     assert b"Music Analyzer Project" in response.data
     assert b"Welcome" in response.data
+
+def test_see_more_shows_one_sorted_page_of_the_table(client, store):
+    table = pd.DataFrame({
+        "track": [f"Song {number:03d}" for number in range(120)],
+        "artist": ["Artist"] * 120,
+        "scrobble count": list(range(120, 0, -1))
+    }, index=range(1, 121))
+
+    with client.session_transaction() as session:
+        session["analysis_id"] = store.save({"tables": {"tracks": tables.table_to_lists(table)}})
+
+    response = client.get("/spotify_analysis/tracks?page=2&sort=track&order=desc")
+
+    assert response.status_code == 200
+    assert b"Page 2 of 3" in response.data
+    assert b"Song 069" in response.data and b"Song 020" in response.data
+    assert b"Song 070" not in response.data and b"Song 019" not in response.data
+
+def test_see_more_without_a_table_redirects(client):
+    response = client.get("/spotify_analysis/tracks")
+
+    assert response.status_code == 302
+
+def test_spotify_analysis_runs_as_a_job(client, runner, tmp_path):
+    history = json.dumps([
+        {
+            "ts": f"2024-03-{day:02d}T10:00:00Z",
+            "ms_played": 60000,
+            "master_metadata_track_name": f"Song {day % 3}",
+            "master_metadata_album_artist_name": "Artist",
+            "master_metadata_album_album_name": "Album",
+            "spotify_track_uri": f"spotify:track:{day % 3}"
+        }
+        for day in range(1, 20)
+    ]).encode()
+
+    with patch.object(parse_cache, "CACHE_DIR", str(tmp_path / "parse_cache")), \
+        patch.object(upload_store, "UPLOAD_DIR", str(tmp_path / "uploads")), \
+        patch.object(analysis.get_data, "all_similar_artists", return_value=pd.DataFrame(columns=["name", "url", "match"])), \
+        patch.object(runner, "submit", wraps=runner.submit) as submit:
+        response = client.post(
+            "/spotify_analysis",
+            data={"file": [(io.BytesIO(history), "history.json"), (io.BytesIO(history), "again.json")]},
+            content_type="multipart/form-data"
+        )
+        job_id = re.search(r"/progress/([0-9a-f]+)", response.data.decode()).group(1)
+        runner.futures[job_id].result(timeout=30)
+
+    progress = client.get(f"/progress/{job_id}").get_json()
+    finished = client.get(f"/job/{job_id}")
+    page = client.get(finished.headers["Location"])
+
+    assert progress["status"] == "complete" and progress["progress"] == 100
+    assert finished.status_code == 302
+    assert page.status_code == 200
+    assert b"Top 15 Tracks" in page.data
+    assert b"19 streams were in more than one of the uploaded files" in page.data
+    assert client.get("/spotify_analysis/tracks").status_code == 200
+    # the job got the paths of the saved uploads and removed them after parsing
+    assert [filename for filename, _ in submit.call_args.args[1]] == ["history.json", "again.json"]
+    assert not os.listdir(tmp_path / "uploads")
+
+def test_failed_job_shows_its_messages_on_the_main_page(client, runner):
+    with patch.object(analysis.get_data, "top_data_predefined_period", return_value=pd.DataFrame()), \
+        patch.object(main.validation, "username_exists_in_lastfm", return_value=True):
+        response = client.get("/lastfm_analysis/someone/7day")
+        job_id = re.search(r"/progress/([0-9a-f]+)", response.data.decode()).group(1)
+        runner.futures[job_id].result(timeout=30)
+
+    response = client.get(f"/job/{job_id}", follow_redirects=True)
+
+    assert client.get(f"/progress/{job_id}").get_json()["status"] == "failed"
+    assert b"No data available for the selected time period!" in response.data
+
+def top_data(username, data_type, time_period, progress=None):
+    name = "artist" if data_type == "artists" else data_type[:-1]
+
+    return pd.DataFrame({"name": [f"Some {name}"], "artist": ["Artist"], "scrobble count": [3]}, index=[1])
+
+@pytest.fixture
+def lastfm_data():
+    with patch.object(main.validation, "username_exists_in_lastfm", return_value=True), \
+        patch.object(analysis.get_data, "top_data_predefined_period", side_effect=top_data) as fetch, \
+        patch.object(analysis.get_data, "all_similar_artists", return_value=pd.DataFrame(columns=["name", "url", "match"])), \
+        patch.object(main.visualize_data.lastfm_validation, "get_registration_date", return_value=date(2020, 1, 1)):
+        yield fetch
+
+def test_saved_analysis_is_shown_and_refreshed_once_stale(client, runner, store, lastfm_data):
+    response = client.get("/lastfm_analysis/Someone/overall")
+    job_id = re.search(r"/progress/([0-9a-f]+)", response.data.decode()).group(1)
+    runner.futures[job_id].result(timeout=30)
+
+    analysis_id = analysis.cached_analysis_id("lastfm_predefined", "someone", "overall")
+    cached = client.get("/lastfm_analysis/someone/overall")
+
+    assert cached.status_code == 302
+    assert cached.headers["Location"].endswith(f"/analysis/{analysis_id}")
+    assert lastfm_data.call_count == 3
+
+    result = store.load(analysis_id)
+    result["expires"] = 0
+    store.save(result, analysis_id)
+
+    stale = client.get("/lastfm_analysis/someone/overall")
+    refresh_id, = set(runner.futures) - {job_id}
+    runner.futures[refresh_id].result(timeout=30)
+
+    assert stale.status_code == 302
+    assert lastfm_data.call_count == 6
+    assert store.load(analysis_id)["expires"] > 0
+    assert client.get(stale.headers["Location"]).status_code == 200
+
+@pytest.mark.parametrize("end_date, expires", [
+    ("2024-03-02", False),
+    ((date.today() - timedelta(days=1)).isoformat(), True),
+    (date.today().isoformat(), True)
+])
+def test_only_recent_custom_ranges_expire(store, end_date, expires):
+    scrobbles = analysis.get_data.scrobbles_to_dataframe([
+        {"uts": 1709290000, "track": "Roads", "artist": "Portishead", "album": "Dummy"}
+    ])
+    progress = jobs.JobProgress(lambda changes: None)
+
+    with app.test_request_context(), \
+        patch.object(analysis.scrobble_store, "recent_tracks_by_custom_dates", return_value=scrobbles), \
+        patch.object(analysis.get_data, "all_similar_artists", return_value=pd.DataFrame(columns=["name", "url", "match"])):
+        analysis_id = analysis.lastfm_custom(progress, "someone", "2024-03-01", end_date)
+
+    assert (store.load(analysis_id)["expires"] is not None) == expires
+
+def test_jobs_with_the_same_key_are_shared(runner):
+    started = threading.Event()
+
+    def slow_task(progress):
+        started.wait(5)
+
+    with patch.dict(jobs.TASKS, {"slow_task": slow_task}):
+        first = runner.submit("slow_task", key="same")
+        second = runner.submit("slow_task", key="same")
+        started.set()
+        runner.futures[first].result(timeout=5)
+        third = runner.submit("slow_task", key="same")
+        runner.futures[third].result(timeout=5)
+
+    assert first == second != third
@@ -1,13 +1,216 @@
-# from unittest.mock import patch, Mock
+import time
+from contextlib import closing
+from unittest.mock import patch, Mock
 
 import pytest
 import pandas as pd
 
 from main import app
-from utils.lastfm import get_data
+from utils import validation
+from utils.lastfm import get_data, lastfm_validation, scrobble_store
+from utils.lastfm.client import lastfm_client
 
 @pytest.fixture
 def client():
     app.testing = True
     with app.test_client() as client:
         yield client
+
+@pytest.fixture(autouse=True)
+def plain_lastfm_client():
+    "Calls in the tests are neither cached nor rate limited."
+    with patch.object(lastfm_client, "cache", None), \
+        patch.object(lastfm_client, "rate_limiter", None):
+        yield
+
+def top_tracks_response(page: int, total_pages: int) -> Mock:
+    "Fake user.gettoptracks response with two tracks per page."
+    response = Mock(ok=True)
+    response.json.return_value = {
+        "toptracks": {
+            "track": [
+                {
+                    "name": f"track {page}-{i}",
+                    "artist": {"name": "artist"},
+                    "playcount": str(1000 - page * 10 - i)
+                }
+                for i in range(2)
+            ],
+            "@attr": {"totalPages": str(total_pages)}
+        }
+    }
+
+    return response
+
+def fake_top_tracks_get(total_pages: int):
+    "Returns a fake session.get answering by the requested page number."
+    def fake_get(url, params, timeout):
+        if params["method"] == "user.getinfo":
+            return Mock(ok=True)
+
+        return top_tracks_response(params["page"], total_pages)
+
+    return fake_get
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_top_data_predefined_period_keeps_page_order(max_workers):
+    with app.test_request_context(), \
+        patch.object(lastfm_client.session, "get", side_effect=fake_top_tracks_get(7)):
+        top_tracks = get_data.top_data_predefined_period(
+            "user", "tracks", "overall", max_workers=max_workers
+        )
+
+    assert list(top_tracks.columns) == ["name", "artist", "scrobble count"]
+    assert list(top_tracks.index) == list(range(1, 15))
+    assert list(top_tracks["name"]) == [
+        f"track {page}-{i}" for page in range(1, 8) for i in range(2)
+    ]
+
+def recent_tracks_response(page: int, total_pages: int) -> Mock:
+    "Fake user.getrecenttracks response, the last scrobble repeats on the next page."
+    tracks = [
+        {
+            "name": f"track {uts}",
+            "artist": {"#text": "artist"},
+            "album": {"#text": "album"},
+            "date": {"uts": str(uts)}
+        }
+        for uts in range(1000 - page * 10, 1000 - page * 10 - 11, -1)
+    ]
+
+    if page == 1:
+        tracks.insert(0, {
+            "name": "now playing",
+            "artist": {"#text": "artist"},
+            "album": {"#text": "album"},
+            "@attr": {"nowplaying": "true"}
+        })
+
+    response = Mock(ok=True)
+    response.json.return_value = {
+        "recenttracks": {
+            "track": tracks,
+            "@attr": {"total": str(total_pages * 10), "totalPages": str(total_pages)}
+        }
+    }
+
+    return response
+
+def test_recent_tracks_by_custom_dates_merges_pages():
+    def fake_get(url, params, timeout):
+        return recent_tracks_response(params["page"], 5)
+
+    with app.test_request_context(), \
+        patch.object(lastfm_client.session, "get", side_effect=fake_get):
+        recent_tracks = get_data.recent_tracks_by_custom_dates(
+            "user", "2024-01-01", "2024-12-31", max_workers=3
+        )
+
+    assert list(recent_tracks.columns) == ["track", "artist", "album", "scrobble_time"]
+    assert len(recent_tracks) == 51
+    assert recent_tracks["track"].is_unique
+    assert recent_tracks["scrobble_time"].is_monotonic_decreasing
+
+def test_scrobble_store_fetches_only_missing_ranges(tmp_path):
+    scrobbles = [
+        {"uts": uts, "track": f"track {uts}", "artist": "artist", "album": "album"}
+        for uts in range(100, 0, -10)
+    ]
+
+    def fake_recent_scrobbles(username, start_timestamp, end_timestamp, progress=None):
+        return [
+            scrobble for scrobble in scrobbles
+            if start_timestamp <= scrobble["uts"] <= end_timestamp
+        ]
+
+    with patch.object(scrobble_store, "STORE_PATH", str(tmp_path / "store.sqlite3")), \
+        patch.object(get_data, "recent_scrobbles", side_effect=fake_recent_scrobbles) as fetch:
+        assert scrobble_store.sync_scrobbles("User", 30, 70)
+        assert scrobble_store.sync_scrobbles("user", 40, 60)
+        assert fetch.call_count == 1
+
+        assert scrobble_store.sync_scrobbles("user", 10, 90)
+        assert [call.args[1:] for call in fetch.call_args_list[1:]] == [(10, 29), (71, 90)]
+
+        stored = scrobble_store.stored_scrobbles("USER", 20, 80)
+
+    assert [scrobble["uts"] for scrobble in stored] == [80, 70, 60, 50, 40, 30, 20]
+
+def test_scrobble_store_keeps_separate_synced_intervals(tmp_path):
+    with patch.object(scrobble_store, "STORE_PATH", str(tmp_path / "store.sqlite3")), \
+        patch.object(get_data, "recent_scrobbles", return_value=[]) as fetch:
+        assert scrobble_store.sync_scrobbles("user", 100, 200)
+        assert scrobble_store.sync_scrobbles("user", 1000, 1100)
+        assert scrobble_store.sync_scrobbles("user", 150, 1050)
+
+        with closing(scrobble_store.connect()) as connection:
+            intervals = scrobble_store.synced_intervals(connection, "user")
+
+    assert [call.args[1:] for call in fetch.call_args_list] == [(100, 200), (1000, 1100), (201, 999)]
+    assert intervals == [(100, 1100)]
+
+def test_scrobble_store_fetches_late_scrobbles_again(tmp_path):
+    now = int(time.time())
+    scrobbles = [{"uts": now - 3600, "track": "track", "artist": "artist", "album": "album"}]
+
+    def fake_recent_scrobbles(username, start_timestamp, end_timestamp, progress=None):
+        return list(scrobbles)
+
+    with patch.object(scrobble_store, "STORE_PATH", str(tmp_path / "store.sqlite3")), \
+        patch.object(get_data, "recent_scrobbles", side_effect=fake_recent_scrobbles) as fetch:
+        assert scrobble_store.sync_scrobbles("user", now - 7200, now)
+
+        # submitted later, but timestamped with the time the track started
+        scrobbles.append({"uts": now - 5400, "track": "late", "artist": "artist", "album": "album"})
+        assert scrobble_store.sync_scrobbles("user", now - 7200, now)
+
+        stored = scrobble_store.stored_scrobbles("user", now - 7200, now)
+
+    assert fetch.call_count == 2
+    assert [scrobble["track"] for scrobble in stored] == ["track", "late"]
+
+def test_user_info_is_fetched_once_per_request():
+    user_info = Mock(ok=True)
+    user_info.json.return_value = {"user": {"registered": {"unixtime": "1262304000"}}}
+
+    with app.test_request_context(), \
+        patch.object(lastfm_client.session, "get", return_value=user_info) as get:
+        assert lastfm_validation.check_if_user_exists("User")
+        assert validation.username_exists_in_lastfm("user")
+        assert lastfm_validation.get_registration_date("USER").year in (2009, 2010)
+
+    assert get.call_count == 1
+
+SIMILAR = {
+    "A": [("B", 0.9), ("C", 0.8), ("X", 0.75)],
+    "B": [("A", 0.9), ("X", 0.95), ("D", 0.5)],
+    "X": [("Y", 1.0)],
+}
+
+def similar_artists_response(artist: str) -> Mock:
+    response = Mock(ok=True)
+    response.json.return_value = {
+        "similarartists": {
+            "artist": [
+                {"name": name, "url": f"https://last.fm/{name}", "match": str(match)}
+                for name, match in SIMILAR.get(artist.upper(), [])
+            ]
+        }
+    }
+
+    return response
+
+@pytest.mark.parametrize("depth, expected", [
+    (1, ["X", "C"]),
+    (2, ["X", "Y", "C"]),
+])
+def test_all_similar_artists_ranks_by_match(depth, expected):
+    def fake_get(url, params, timeout):
+        return similar_artists_response(params["artist"])
+
+    with app.test_request_context(), \
+        patch.object(lastfm_client.session, "get", side_effect=fake_get):
+        similar = get_data.all_similar_artists(pd.Series(["A", "b"]), depth=depth)
+
+    assert list(similar["name"]) == expected
+    assert list(similar.columns) == ["name", "url", "match"]
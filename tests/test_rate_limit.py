@@ -0,0 +1,102 @@
+import json
+import time
+import threading
+from unittest.mock import patch
+
+import requests
+
+from utils.rate_limit import TokenBucket, backoff_delay, retry_after_seconds
+from utils.lastfm.client import LastfmClient
+
+def response_with(status_code: int, data: dict, headers: dict | None=None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(data).encode()
+    response.headers.update(headers or {})
+
+    return response
+
+def test_token_bucket_allows_bursts_then_paces():
+    bucket = TokenBucket(rate=10, capacity=2)
+
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.09 < bucket.reserve() <= 0.1
+    assert 0.19 < bucket.reserve() <= 0.2
+
+def test_pause_holds_back_every_thread():
+    bucket = TokenBucket(rate=100, capacity=5)
+    waited = []
+
+    def call():
+        started = time.monotonic()
+        bucket.acquire()
+        waited.append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    bucket.pause(0.2)
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(waited) == 2
+    assert min(waited) >= 0.19
+
+def test_rate_limited_call_pauses_the_other_threads():
+    client = LastfmClient("key", rate_limiter=TokenBucket(rate=100, capacity=5))
+    calls = []
+    lock = threading.Lock()
+
+    def fake_get(*args, **kwargs):
+        with lock:
+            calls.append(time.monotonic())
+
+            if len(calls) == 1:
+                return response_with(429, {"error": 29}, {"Retry-After": "0.3"})
+
+        return response_with(200, {"user": {}})
+
+    def call():
+        client.get("user.getinfo", {"user": "user"})
+
+    with patch.object(client.session, "get", side_effect=fake_get):
+        first = threading.Thread(target=call)
+        first.start()
+
+        # the second thread starts once the first one got the 429
+        while not client.rate_limiter.remaining_pause():
+            time.sleep(0.001)
+
+        second = threading.Thread(target=call)
+        second.start()
+        first.join()
+        second.join()
+
+    # the retry and the call of the second thread wait for the pause
+    assert len(calls) == 3
+    assert all(called - calls[0] >= 0.3 for called in calls[1:])
+
+def test_backoff_prefers_retry_after():
+    assert retry_after_seconds({"Retry-After": "3"}) == 3
+    assert retry_after_seconds({}) is None
+    assert 3 <= backoff_delay(0, 3) <= 3.5
+    assert 0 <= backoff_delay(4) <= 8
+
+def test_client_retries_rate_limited_calls():
+    client = LastfmClient("key")
+    responses = [
+        response_with(429, {"error": 29, "message": "Rate Limit Exceeded"}, {"Retry-After": "1"}),
+        response_with(200, {"error": 29, "message": "Rate Limit Exceeded"}),
+        response_with(200, {"user": {}})
+    ]
+
+    with patch.object(client.session, "get", side_effect=responses) as get, \
+        patch("utils.lastfm.client.time.sleep") as sleep:
+        response = client.get("user.getinfo", {"user": "user"})
+
+    assert response.json() == {"user": {}}
+    assert get.call_count == 3
+    assert sleep.call_count == 2
+    assert sleep.call_args_list[0].args[0] >= 1
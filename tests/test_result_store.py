@@ -0,0 +1,31 @@
+import os
+import time
+
+from utils.result_store import FileResultStore
+
+def test_file_result_store_round_trip(tmp_path):
+    store = FileResultStore(str(tmp_path), 1024 * 1024, 60)
+    result = {"tables": {"artists": {"columns": ["artist"], "index": [1], "data": [["Portishead"]]}}}
+
+    analysis_id = store.save(result)
+
+    assert store.load(analysis_id) == result
+    assert store.load("0" * 32) is None
+    assert store.load("../" + analysis_id) is None
+
+def test_file_result_store_evicts_old_and_least_recently_used(tmp_path):
+    store = FileResultStore(str(tmp_path), 1024 * 1024, 60)
+
+    expired = store.save({"data": "expired"})
+    os.utime(store.path(expired), (time.time() - 120, time.time() - 120))
+
+    assert store.load(expired) is None
+
+    store.max_bytes = 2 * os.path.getsize(store.path(store.save({"data": "x" * 100})))
+    least_recent = store.save({"data": "y" * 100})
+    os.utime(store.path(least_recent), (0, 0))
+    newest = store.save({"data": "z" * 100})
+
+    assert not os.path.exists(store.path(expired))
+    assert not os.path.exists(store.path(least_recent))
+    assert store.load(newest) == {"data": "z" * 100}
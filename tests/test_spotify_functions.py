@@ -0,0 +1,133 @@
+import os
+import time
+import asyncio
+import importlib
+import threading
+from unittest.mock import patch, Mock
+
+import pandas as pd
+
+os.environ.setdefault("SPOTIPY_CLIENT_ID", "test-client-id")
+os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "test-client-secret")
+
+from utils.rate_limit import TokenBucket
+
+spotify_async = importlib.import_module("utils.spotify.async")
+
+def test_collect_data_bounds_concurrent_calls():
+    lock = threading.Lock()
+    calls = {"in_flight": 0, "peak": 0}
+
+    def slow(result):
+        def call(*args):
+            with lock:
+                calls["in_flight"] += 1
+                calls["peak"] = max(calls["peak"], calls["in_flight"])
+
+            time.sleep(0.01)
+
+            with lock:
+                calls["in_flight"] -= 1
+
+            return result(*args)
+
+        return call
+
+    tracks = pd.DataFrame({"name": [f"track {i}" for i in range(30)], "artist": "artist"})
+    artists = pd.DataFrame({"name": [f"artist {i}" for i in range(30)]})
+
+    with patch.object(spotify_async.non_async, "rate_limiter", TokenBucket(rate=1e6, capacity=1e6)), \
+        patch.multiple(
+        spotify_async.non_async,
+        get_track_or_album_uri=slow(lambda data_type, name, artist: f"uri:{name}"),
+        get_artist_uri=slow(lambda name: f"uri:{name}"),
+        get_tracks_data=slow(lambda uris: pd.DataFrame({
+            "name": [uri[4:] for uri in uris],
+            "artist": "artist",
+            "duration": 200,
+            "popularity": 50
+        })),
+        get_artists_data=slow(lambda uris: pd.DataFrame({
+            "name": [uri[4:] for uri in uris],
+            "popularity": 50
+        }))
+    ):
+        (tracks_all, not_found), (artists_all, _) = asyncio.run(
+            spotify_async.collect_data(tracks, artists, concurrency=4)
+        )
+
+    assert calls["peak"] == 4
+    assert not not_found
+    assert tracks_all["popularity"].notna().all()
+    assert len(artists_all) == 30
+
+def test_async_calls_wait_for_the_rate_limiter_on_the_event_loop():
+    bucket = TokenBucket(rate=1e6, capacity=1)
+
+    async def run_calls():
+        spotify_async.set_concurrency(2)
+
+        return await asyncio.gather(
+            spotify_async.run_limited(spotify_async.non_async.call_spotify, lambda: "called"),
+            spotify_async.run_limited(lambda: "cached")
+        )
+
+    with patch.object(spotify_async.non_async, "rate_limiter", bucket), \
+        patch.object(bucket, "acquire", wraps=bucket.acquire) as blocking_acquire, \
+        patch.object(bucket, "refund", wraps=bucket.refund) as refund:
+        assert asyncio.run(run_calls()) == ["called", "cached"]
+
+    # the call used the token taken on the event loop and the cached lookup gave its token back
+    blocking_acquire.assert_not_called()
+    refund.assert_called_once()
+
+def test_uri_lookups_are_cached_including_not_found(tmp_path):
+    non_async = spotify_async.non_async
+
+    def fake_search(data_type, name, artist):
+        return None if name == "unknown" else f"spotify:track:{name}"
+
+    with patch.object(non_async.uri_cache, "CACHE_PATH", str(tmp_path / "uris.sqlite3")), \
+        patch.object(non_async, "search_track_or_album_uri", side_effect=fake_search) as search:
+        assert non_async.get_track_or_album_uri("track", "Song", "Artist") == "spotify:track:Song"
+        assert non_async.get_track_or_album_uri("track", " song ", "ARTIST") == "spotify:track:Song"
+        assert non_async.get_track_or_album_uri("track", "unknown", "Artist") is None
+        assert non_async.get_track_or_album_uri("track", "Unknown", "artist") is None
+
+        assert search.call_count == 2
+
+        with patch.object(non_async.uri_cache, "NOT_FOUND_TTL", -1):
+            non_async.uri_cache.store_uri("track", "unknown", "artist", None)
+
+        non_async.get_track_or_album_uri("track", "unknown", "artist")
+
+        # the thread reuses its connection
+        assert non_async.uri_cache.connect() is non_async.uri_cache.connect()
+
+    assert search.call_count == 3
+
+def test_bulk_export_resumes_partial_file(tmp_path):
+    export_to_file = importlib.import_module("utils.spotify.export_to_file")
+    path = tmp_path / "all_tracks_uris.jsonl"
+    path.write_text(
+        '{"name": "song 0", "artist": "artist", "uri": "uri:song 0"}\n'
+        '{"name": "song 1", "arti',
+        encoding="utf-8"
+    )
+    keys = [(f"song {i}", "artist") for i in range(20)]
+    resolved = []
+
+    def resolve(name, artist):
+        resolved.append(name)
+        return f"uri:{name}"
+
+    progress = Mock()
+    export_to_file.export_uris_bulk(str(path), ("name", "artist"), keys, resolve, max_workers=3, progress=progress)
+
+    assert "song 0" not in resolved
+    assert len(resolved) == 19
+    assert progress.call_args_list[0].args == (0, 19)
+    assert progress.call_args_list[-1].args == (19, 19)
+
+    exported = export_to_file.read_exported(str(path), ("name", "artist"))
+    assert exported == set(keys)
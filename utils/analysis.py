@@ -0,0 +1,218 @@
+"""
+    The analyses which run as background jobs. Every analysis collects
+    the data, aggregates it, saves the result in the result store
+    and returns the id of the result (None if the data was not valid).
+
+    Last.fm analyses are saved under an id made from the user and the time period,
+    so a later request shows the saved result right away and only refreshes it
+    in the background once it is older than ANALYSIS_TTL. Custom time periods
+    which ended before the late scrobble window of the scrobble store
+    can't change and are never refreshed.
+"""
+
+import os
+import time
+import hashlib
+from contextlib import ExitStack
+from datetime import date, timedelta
+
+from flask import flash
+from werkzeug.datastructures import FileStorage
+
+from utils import validation, upload_store
+from utils.jobs import task, JobProgress
+from utils.result_store import result_store
+from utils.lastfm import get_data, scrobble_store
+from utils.data_processing import visualize_data, extended_history, aggregate, tables
+
+# seconds after which a saved Last.fm analysis is refreshed
+ANALYSIS_TTL = int(os.getenv("ANALYSIS_TTL", str(60 * 60)))
+
+def cached_analysis_id(task_name: str, username: str, *period: str) -> str:
+    "The analysis id of a task for a user and a time period."
+
+    key = "\0".join([task_name, username.lower(), *period])
+
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+def is_stale(result: dict) -> bool:
+    "Checks if a saved analysis should be refreshed."
+    return result.get("expires") is not None and result["expires"] < time.time()
+
+def save_result(result: dict, analysis_id: str | None, ttl: float | None) -> str:
+    "Save a result which is refreshed after ttl seconds (None - never)."
+
+    result["expires"] = None if ttl is None else time.time() + ttl
+
+    return result_store.save(result, analysis_id)
+
+@task
+def lastfm_predefined(
+        progress: JobProgress,
+        username: str,
+        time_period: str,
+        analysis_id: str | None=None
+    ) -> str | None:
+    "Last.fm top data for a predefined time period, saved under analysis_id if given."
+
+    top_data = {}
+    progress.steps = 4
+
+    for step, data_type in enumerate(["tracks", "albums", "artists"]):
+        progress.start_step(step, f"Fetching top {data_type}")
+        top_data[data_type] = get_data.top_data_predefined_period(
+            username,
+            data_type,
+            time_period,
+            progress=progress.pages
+        )
+
+        if not validation.non_empty_dataframe(top_data[data_type]):
+            return None
+
+    progress.start_step(3, "Finding similar artists")
+
+    overall_stats = visualize_data.get_total_stats_from_lastfm(
+        username,
+        top_data,
+        time_period
+    )
+
+    similar_artists = get_data.all_similar_artists(top_data["artists"]["name"]).head(10)
+
+    return save_result({
+        "template": "lastfm_analysis.html",
+        "template_args": {
+            "title": f"{username} Track Analysis",
+            "username": username,
+            "time_period": time_period
+        },
+        "tables": {
+            data_type: tables.table_to_lists(table)
+            for data_type, table in top_data.items()
+        },
+        "is_custom": False,
+        "overall_stats": tables.table_to_lists(overall_stats),
+        "similar_artists": similar_artists.to_dict(orient="records")
+    }, analysis_id, ANALYSIS_TTL)
+
+@task
+def lastfm_custom(
+        progress: JobProgress,
+        username: str,
+        start_date: str,
+        end_date: str,
+        analysis_id: str | None=None
+    ) -> str | None:
+    """Last.fm scrobbles for a custom time frame - from start_date to end_date,
+    saved under analysis_id if given.
+    """
+
+    progress.steps = 2
+    progress.start_step(0, "Fetching scrobbles")
+
+    custom_data = scrobble_store.recent_tracks_by_custom_dates(
+        username,
+        start_date,
+        end_date,
+        progress=progress.pages
+    )
+
+    if not validation.non_empty_dataframe(custom_data):
+        return None
+
+    progress.start_step(1, "Finding similar artists")
+
+    result = history_result(
+        custom_data,
+        date.fromisoformat(start_date),
+        date.fromisoformat(end_date),
+        username
+    )
+    result["template"] = "lastfm_analysis_custom.html"
+    result["template_args"] = {
+        "title": f"{username} Track Analysis",
+        "username": username,
+        "start_date": start_date,
+        "end_date": end_date,
+        "time_period": "custom"
+    }
+
+    # the scrobbles of a time period don't change anymore once late scrobbles can't come in
+    settled_until = date.today() - timedelta(seconds=scrobble_store.LATE_SCROBBLE_WINDOW)
+    ttl = None if date.fromisoformat(end_date) < settled_until else ANALYSIS_TTL
+
+    return save_result(result, analysis_id, ttl)
+
+@task
+def spotify(progress: JobProgress, uploads: list[tuple[str, str]]) -> str | None:
+    """Spotify extended streaming history from uploaded files,
+    the saved files are removed once they are parsed.
+
+    Keyword arguments:
+    - uploads -- the names and the saved paths of the uploaded json or zip files
+    """
+
+    progress.steps = 2
+    progress.start_step(0, "Reading the uploaded files")
+
+    try:
+        with ExitStack() as stack:
+            all_dataframes = extended_history.parse_file_data([
+                FileStorage(stack.enter_context(open(path, "rb")), filename=filename)
+                for filename, path in uploads
+            ])
+    finally:
+        upload_store.remove_uploads(uploads)
+
+    if not validation.non_empty_dataframe(all_dataframes):
+        return None
+
+    if all_dataframes.attrs.get("duplicate_streams"):
+        flash(
+            f"{all_dataframes.attrs['duplicate_streams']} streams were in more "
+            "than one of the uploaded files and were counted once."
+        )
+
+    progress.start_step(1, "Finding similar artists")
+
+    start_date = all_dataframes["scrobble_time"].min().date()
+    end_date = all_dataframes["scrobble_time"].max().date()
+
+    result = history_result(all_dataframes, start_date, end_date)
+    result["template"] = "spotify_analysis.html"
+    result["template_args"] = {
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat()
+    }
+
+    return save_result(result, None, None)
+
+def history_result(history, start_date: date, end_date: date, username: str="") -> dict:
+    "The tables, overall stats, cumulative series and similar artists of a listening history."
+
+    grouped_data = aggregate.top_counts(history)
+
+    overall_stats = visualize_data.get_total_stats_from_lastfm(
+        username,
+        grouped_data,
+        start_date=start_date,
+        end_date=end_date
+        )
+
+    similar_artists = get_data.all_similar_artists(grouped_data["artists"]["artist"]).head(10)
+
+    return {
+        "tables": {
+            data_type: tables.table_to_lists(table)
+            for data_type, table in grouped_data.items()
+        },
+        "is_custom": True,
+        "overall_stats": tables.table_to_lists(overall_stats),
+        "cumulative": tables.table_to_lists(
+            aggregate.cumulative_counts(history, start_date=start_date, end_date=end_date)
+        ),
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "similar_artists": similar_artists.to_dict(orient="records")
+    }
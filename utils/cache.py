@@ -0,0 +1,168 @@
+"""
+    Key-value caches with a time to live which can be
+    shared between different parts of the application.
+    - LRUCache - in-process, evicts the least recently used
+    entries once the size limit is reached
+    - RedisCache - shared between all workers using the same Redis server
+    - evict_least_recently_used - bounds the size of a folder of cache files
+
+    REDIS_URL is the Redis server of every part which uses the redis backend.
+"""
+
+import os
+import time
+import shutil
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+
+import dotenv
+import redis
+
+dotenv.load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+class LRUCache:
+    "In-process cache of byte values bounded by their total size."
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        "Return the value of a key or None if it is missing or expired."
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+
+            return value
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        "Store a value for ttl seconds, evicting the oldest entries if needed."
+        if len(value) > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.current_bytes += len(value)
+
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str) -> None:
+        _, value = self.entries.pop(key)
+        self.current_bytes -= len(value)
+
+class RedisCache:
+    """Cache stored in Redis so all workers share the same entries.
+    If Redis can't be reached the cache behaves as if it was empty.
+    """
+
+    def __init__(self, url: str, prefix: str="music-analyzer:"):
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str) -> bytes | None:
+        "Return the value of a key or None if it is missing or expired."
+        try:
+            return self.redis.get(self.prefix + key)
+        except redis.RedisError:
+            return None
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        "Store a value for ttl seconds."
+        try:
+            self.redis.set(self.prefix + key, value, ex=max(1, int(ttl)))
+        except redis.RedisError:
+            pass
+
+def create_cache(backend: str, max_bytes: int, redis_url: str) -> LRUCache | RedisCache | None:
+    """Return a cache for the given backend name.
+
+    Keyword arguments:
+    - backend -- memory | redis | none
+    - max_bytes -- size limit of the in-process cache
+    - redis_url -- url of the Redis server for the redis backend
+    """
+
+    match backend:
+        case "memory":
+            return LRUCache(max_bytes)
+        case "redis":
+            return RedisCache(redis_url)
+        case _:
+            return None
+
+def evict_least_recently_used(
+        directory: str,
+        max_bytes: int,
+        max_age: float | None=None,
+        is_entry: Callable[[os.DirEntry], bool]=lambda entry: True,
+        entry_size: Callable[[os.DirEntry], int]=lambda entry: entry.stat().st_size
+    ) -> None:
+    """Remove the entries of a folder which weren't used for max_age seconds
+    and then the least recently used ones until all of them fit into max_bytes.
+    The modification time of an entry is its last use. The callers hold
+    their own lock, so the same folder isn't evicted twice at once.
+
+    Keyword arguments:
+    - directory -- the folder of the entries - files or folders
+    - max_bytes -- the size limit of all entries
+    - max_age (optional) -- seconds after which an unused entry is removed, None - never
+    - is_entry (optional) -- checks if a file or folder is an entry, e.g. not a temporary file
+    - entry_size (optional) -- the size of an entry, the size of the file by default
+    """
+
+    oldest_allowed = None if max_age is None else time.time() - max_age
+    entries = []
+
+    for entry in os.scandir(directory):
+        try:
+            if not is_entry(entry):
+                continue
+
+            last_used = entry.stat().st_mtime
+
+            if oldest_allowed is not None and last_used < oldest_allowed:
+                remove_entry(entry.path)
+            else:
+                entries.append((last_used, entry_size(entry), entry.path))
+        except OSError:
+            continue
+
+    total_bytes = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+
+        remove_entry(path)
+        total_bytes -= size
+
+def remove_entry(path: str) -> None:
+    "Remove a cache file or folder, it could have been removed already."
+
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        return
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
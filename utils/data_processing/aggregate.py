@@ -0,0 +1,166 @@
+"""
+    Scrobble counts of the tracks, albums and artists
+    in a listening history, computed in one pass over the history.
+"""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+# data type -> the columns which identify one item
+DATA_TYPE_COLUMNS = {
+    "tracks": ["track", "artist"],
+    "albums": ["album", "artist"],
+    "artists": ["artist"]
+}
+
+# bucket -> the numpy datetime unit the scrobble times are truncated to
+BUCKET_UNITS = {"D": "D", "W": "D", "M": "M"}
+
+def factorize(column: pd.Series) -> tuple[np.ndarray, pd.Index]:
+    "Return the codes (-1 for missing values) and the sorted distinct values of a column."
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(np.int64), column.cat.categories
+
+    codes, values = pd.factorize(column, sort=True)
+
+    return codes.astype(np.int64), values
+
+def count_table(
+        counts: np.ndarray,
+        codes: dict[str, np.ndarray],
+        values: dict[str, pd.Index]
+    ) -> pd.DataFrame:
+    """Sum the counts of the combinations by the given columns
+    and return them as a table with the most scrobbled items first.
+    Combinations with a missing value are left out.
+    """
+
+    present = np.logical_and.reduce([column_codes >= 0 for column_codes in codes.values()])
+    item_codes = np.vstack([column_codes[present] for column_codes in codes.values()])
+
+    items, item_index = np.unique(item_codes, axis=1, return_inverse=True)
+    item_counts = np.bincount(item_index.ravel(), weights=counts[present], minlength=items.shape[1])
+
+    table = pd.DataFrame({
+        column: pd.Categorical.from_codes(items[i], values[column])
+        for i, column in enumerate(codes)
+    })
+    table["scrobble count"] = item_counts.astype(np.int64)
+
+    table.sort_values("scrobble count", ascending=False, kind="stable", inplace=True, ignore_index=True)
+    table.index += 1
+
+    return table
+
+def top_counts(history: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """Return the scrobble count tables of the tracks, albums and artists.
+
+    Track, album and artist are factorized once and the history is counted
+    once per distinct (track, album, artist) combination. The three tables
+    are then summed from those combinations, which are far fewer than the
+    scrobbles.
+
+    Keyword arguments:
+    - history -- dataframe with track, album and artist columns
+    Return: a dict of tables with the columns track/album/artist,
+    artist and "scrobble count" under tracks, albums and artists
+    """
+
+    codes = {}
+    values = {}
+
+    for column in ["track", "album", "artist"]:
+        codes[column], values[column] = factorize(history[column])
+
+    # one integer per combination, the missing value -1 is shifted to 0
+    sizes = [len(values[column]) + 1 for column in codes]
+    combination_keys = np.ravel_multi_index(
+        [codes[column] + 1 for column in codes],
+        sizes
+    )
+
+    combinations, counts = np.unique(combination_keys, return_counts=True)
+    combination_codes = dict(zip(codes, (
+        column_codes - 1
+        for column_codes in np.unravel_index(combinations, sizes)
+    )))
+
+    return {
+        data_type: count_table(
+            counts,
+            {column: combination_codes[column] for column in columns},
+            values
+        )
+        for data_type, columns in DATA_TYPE_COLUMNS.items()
+    }
+
+def adaptive_bucket(start_date: date, end_date: date) -> str:
+    "Return the bucket size for a time period - days up to 15 days, weeks up to a month, otherwise months."
+
+    days_difference = (end_date - start_date).days
+
+    if days_difference <= 15:
+        return "D"
+    if days_difference <= 31:
+        return "W"
+
+    return "M"
+
+def time_buckets(scrobble_times: pd.Series, bucket: str) -> np.ndarray:
+    """Truncate the scrobble times to the start of their day, week (starting on Monday)
+    or month. Timezone aware times are truncated in their own timezone.
+    """
+
+    if scrobble_times.dt.tz is not None:
+        scrobble_times = scrobble_times.dt.tz_localize(None)
+
+    buckets = scrobble_times.to_numpy().astype(f"datetime64[{BUCKET_UNITS[bucket]}]")
+
+    if bucket == "W":
+        # 1970-01-01 was a Thursday
+        days = buckets.view(np.int64)
+        buckets = (days - (days + 3) % 7).view("datetime64[D]")
+
+    return buckets
+
+def cumulative_counts(
+        history: pd.DataFrame,
+        bucket: str="adaptive",
+        start_date: date | None=None,
+        end_date: date | None=None
+    ) -> pd.DataFrame:
+    """Return the cumulative number of distinct artists, tracks
+    and albums per time bucket without changing the history.
+
+    Keyword arguments:
+    - history -- dataframe with scrobble_time, artist, track and album columns
+    - bucket (optional) -- D | W | M | adaptive - the size of a time bucket,
+    adaptive picks it based on the length of the time period
+    - start_date, end_date (optional) -- the time period for the adaptive bucket,
+    the first and the last scrobble by default
+    Return: a dataframe indexed by the start of every bucket with
+    the columns artist, track and album
+    """
+
+    if bucket == "adaptive":
+        start_date = start_date or history["scrobble_time"].min().date()
+        end_date = end_date or history["scrobble_time"].max().date()
+        bucket = adaptive_bucket(start_date, end_date)
+
+    buckets, bucket_codes = np.unique(time_buckets(history["scrobble_time"], bucket), return_inverse=True)
+    bucket_codes = bucket_codes.ravel()
+
+    cumulative = {}
+
+    for column in ["artist", "track", "album"]:
+        codes, values = factorize(history[column])
+        present = codes >= 0
+
+        # every item counts once per bucket it was listened to in
+        pairs = np.unique(bucket_codes[present] * (len(values) + 1) + codes[present])
+        cumulative[column] = np.cumsum(np.bincount(pairs // (len(values) + 1), minlength=len(buckets)))
+
+    return pd.DataFrame(cumulative, index=pd.DatetimeIndex(buckets.astype("datetime64[ns]"), name="time_group"))
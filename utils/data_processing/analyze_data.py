@@ -5,11 +5,18 @@
 
 import os
 import json
+import threading
 
 import pandas as pd
 
 from utils.spotify import non_async
 
+TRACK_URIS_PATH = os.path.join("static", "all_tracks_uris.json")
+
+# path -> (modification time, index) so the file is only read again after it changes
+_track_uri_indexes: dict[str, tuple[float, pd.DataFrame]] = {}
+_track_uri_indexes_lock = threading.Lock()
+
 def merge_tracks_data_predefined(lastfm_tracks_data: pd.DataFrame) -> pd.DataFrame:
     "Merge track data from Last.fm and Spotify - non-async."
 
@@ -44,19 +51,69 @@ def merge_artists_data_predefined(lastfm_artists_data: pd.DataFrame, top: int=10
 
     return df_merged
 
-def get_spotify_track_data_from_file(lastfm_data: pd.DataFrame) -> pd.DataFrame:
-    "Read the uri codes of tracks from a file"
-    with open(os.path.join("static", "all_tracks_uris.json"), "r", encoding="utf-8") as fd:
-        tracks_uris = json.load(fd)
+def name_keys(names: pd.Series) -> pd.Series:
+    "Normalize names for case insensitive matching."
+    return names.astype(str).str.lower()
+
+def read_track_uri_index(path: str) -> pd.DataFrame:
+    """Read a JSON or JSONL file of track uri codes into a dataframe with
+    name_key and artist_key columns - one row per normalized (name, artist).
+    """
+
+    with open(path, "r", encoding="utf-8") as fd:
+        if path.endswith(".jsonl"):
+            entries = []
+
+            for line in fd:
+                # the last line can be cut off if an export was interrupted
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        else:
+            entries = json.load(fd)
+
+    # older files contain [name, artist, uri] lists instead of dicts
+    if entries and not isinstance(entries[0], dict):
+        entries = [dict(zip(("name", "artist", "uri"), entry)) for entry in entries]
+
+    index = pd.DataFrame.from_records(entries, columns=["name", "artist", "uri"])
+    index["name_key"] = name_keys(index["name"])
+    index["artist_key"] = name_keys(index["artist"])
+
+    return index.drop_duplicates(["name_key", "artist_key"], ignore_index=True)
+
+def get_track_uri_index(path: str=TRACK_URIS_PATH) -> pd.DataFrame:
+    "Return the index of a track uri file, reading the file only when it has changed."
+
+    modified_at = os.path.getmtime(path)
+
+    with _track_uri_indexes_lock:
+        cached = _track_uri_indexes.get(path)
+
+        if cached is None or cached[0] != modified_at:
+            cached = (modified_at, read_track_uri_index(path))
+            _track_uri_indexes[path] = cached
+
+    return cached[1]
+
+def get_spotify_track_data_from_file(
+        lastfm_data: pd.DataFrame,
+        path: str=TRACK_URIS_PATH
+    ) -> pd.DataFrame:
+    """Read the uri codes of tracks from a file.
+    Returns the name, artist and uri of every Last.fm track found in the file.
+    """
+
+    index = get_track_uri_index(path)
+    keys = pd.DataFrame({
+        "name_key": name_keys(lastfm_data["name"]),
+        "artist_key": name_keys(lastfm_data["artist"])
+    })
 
-        needed_uris = [
-            (name, artist, uri)
-            for _, row in lastfm_data.iterrows()
-            for name, artist, uri in tracks_uris
-            if name.lower() == row["name"].lower() and artist.lower() == row["artist"].lower()
-        ]
+    needed_uris = keys.merge(index, on=["name_key", "artist_key"], how="inner")
 
-    return pd.DataFrame(needed_uris)
+    return needed_uris[["name", "artist", "uri"]]
 
 def get_total_stats_table_predefined(
         tracks_data: pd.DataFrame,
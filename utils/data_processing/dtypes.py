@@ -0,0 +1,67 @@
+"""
+    The compact column types of listening history dataframes
+    from Last.fm and from the Spotify extended streaming history.
+"""
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# names, artists, albums and uris repeat across rows, so they are stored once per value
+CATEGORY_COLUMNS = ["track", "artist", "album", "reason_end", "track_uri"]
+
+COLUMN_DTYPES = {
+    "seconds_played": "float32",
+    "skipped": "boolean"
+}
+
+def compact_history(history: pd.DataFrame) -> pd.DataFrame:
+    """Return the listening history with categorical text columns,
+    a nullable boolean skipped column, float32 seconds and
+    timestamps in seconds. Missing columns are skipped.
+
+    Group by the categorical columns with observed=True,
+    otherwise every combination of categories is returned.
+    """
+
+    dtypes = {
+        column: "category"
+        for column in CATEGORY_COLUMNS
+        if column in history.columns
+    }
+    dtypes.update({
+        column: dtype
+        for column, dtype in COLUMN_DTYPES.items()
+        if column in history.columns
+    })
+
+    history = history.astype(dtypes)
+
+    if "scrobble_time" in history.columns:
+        history["scrobble_time"] = history["scrobble_time"].dt.as_unit("s")
+
+    return history
+
+def concat_histories(histories: list[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate listening histories into one compact history.
+    Every history is compacted on its own and the categories of each
+    categorical column are unified first, so the concatenated columns
+    stay categorical instead of becoming object columns.
+    """
+
+    histories = [compact_history(history) for history in histories]
+
+    for column in CATEGORY_COLUMNS:
+        if not all(column in history.columns for history in histories):
+            continue
+
+        categories = union_categoricals(
+            [history[column] for history in histories],
+            sort_categories=True
+        ).categories
+
+        histories = [
+            history.assign(**{column: history[column].cat.set_categories(categories)})
+            for history in histories
+        ]
+
+    return pd.concat(histories, ignore_index=True)
@@ -3,40 +3,433 @@
     and analyze Spotify listening data based on json files.
 """
 
-import json
-from datetime import datetime
+import io
+import os
+import re
+import zipfile
+import threading
+import multiprocessing
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 
+import msgspec
+import numpy as np
 import pandas as pd
 
-def parse_file_data(uploaded_files: dict) -> pd.DataFrame:
+from utils.data_processing import dtypes, parse_cache
+
+class Stream(msgspec.Struct, gc=False):
+    """The fields of a stream in the extended streaming history
+    which are used - all other fields are skipped while decoding.
+    """
+
+    ts: str
+    ms_played: int
+    master_metadata_track_name: str | None = None
+    master_metadata_album_artist_name: str | None = None
+    master_metadata_album_album_name: str | None = None
+    reason_end: str | None = None
+    skipped: bool | None = None
+    spotify_track_uri: str | None = None
+
+# fields of a stream -> column names
+STREAM_FIELDS = {
+    "master_metadata_track_name": "track",
+    "master_metadata_album_artist_name": "artist",
+    "master_metadata_album_album_name": "album",
+    "ms_played": "seconds_played",
+    "ts": "scrobble_time",
+    "reason_end": "reason_end",
+    "skipped": "skipped",
+    "spotify_track_uri": "track_uri"
+}
+
+# the columns which identify a stream across overlapping exports
+STREAM_KEY = ["scrobble_time", "track_uri", "seconds_played"]
+
+# streams shorter than 30 seconds don't count as listened to
+MIN_MS_PLAYED = 30_000
+
+# how many bytes of a file are read and decoded at once while streaming,
+# the memory used for parsing a file stays around a few times this value
+CHUNK_BYTES = int(os.getenv("SPOTIFY_HISTORY_CHUNK_BYTES", str(16 * 1024 * 1024)))
+
+# a stream which doesn't end within this many bytes after a chunk means the file is malformed
+MAX_STREAM_BYTES = 1024 * 1024
+
+# the audio history files inside the zip of a Spotify data export
+HISTORY_MEMBER_PATTERN = re.compile(r"(^|/)Streaming_History_Audio_[^/]*\.json$")
+
+# how many processes parse uploaded files at once, 1 parses them in the request
+PARSE_WORKERS = int(os.getenv("SPOTIFY_PARSE_WORKERS", str(os.cpu_count() or 1)))
+
+stream_decoder = msgspec.json.Decoder(list[Stream], strict=False)
+
+# number of workers -> process pool
+_parse_pools: dict[int, ProcessPoolExecutor] = {}
+_parse_pools_lock = threading.Lock()
+
+def field_column(streams: list[Stream], field: str, listened: np.ndarray) -> np.ndarray:
+    "Return one field of the listened to streams as a column."
+    return np.array([getattr(stream, field) for stream in streams], dtype=object)[listened]
+
+def streams_to_dataframe(streams: list[Stream]) -> pd.DataFrame:
+    """Load decoded streams straight into columns, filter them
+    with a vectorized mask and convert them into the dataframe used for the analysis.
     """
-        Return a dataframe with all data in the uploads folder.
+
+    ms_played = np.fromiter(
+        (stream.ms_played for stream in streams),
+        dtype=np.int64,
+        count=len(streams)
+    )
+    listened = ms_played >= MIN_MS_PLAYED
+
+    columns = {}
+
+    for field, column in STREAM_FIELDS.items():
+        match field:
+            case "ms_played":
+                columns[column] = ms_played[listened] / 1000
+            case "ts":
+                columns[column] = pd.to_datetime(
+                    field_column(streams, field, listened),
+                    utc=True,
+                    format="ISO8601"
+                )
+            case _:
+                columns[column] = field_column(streams, field, listened)
+
+    streams_data = pd.DataFrame(columns, copy=False)
+    streams_data["skipped"] = streams_data["skipped"].infer_objects()
+
+    return streams_data
+
+def last_stream_end(buffer: bytes) -> int:
+    """Return the index of the "}" which closes the last complete top level
+    object in buffer or -1 if there is none. The buffer has to start outside
+    of a string and of any object. Braces and brackets inside strings
+    are skipped - a quote after an odd number of backslashes is escaped.
     """
 
-    dataframes = []
+    data = np.frombuffer(buffer, dtype=np.uint8)
+
+    quotes = np.flatnonzero(data == ord('"'))
+    backslashes = np.flatnonzero(data == ord("\\"))
+
+    if len(backslashes):
+        # the first backslash of the run of backslashes every backslash is in
+        run_starts = np.flatnonzero(np.diff(backslashes, prepend=-2) != 1)
+        run_start = backslashes[run_starts[np.searchsorted(run_starts, np.arange(len(backslashes)), "right") - 1]]
+
+        before_quote = np.searchsorted(backslashes, quotes) - 1
+        follows_backslash = (before_quote >= 0) & (backslashes[before_quote.clip(0)] == quotes - 1)
+        run_length = np.where(follows_backslash, quotes - run_start[before_quote.clip(0)], 0)
+        quotes = quotes[run_length % 2 == 0]
+
+    opening = np.flatnonzero((data == ord("{")) | (data == ord("[")))
+    closing = np.flatnonzero((data == ord("}")) | (data == ord("]")))
+
+    # a bracket is inside a string if an odd number of quotes is before it
+    opening = opening[np.searchsorted(quotes, opening) % 2 == 0]
+    closing = closing[np.searchsorted(quotes, closing) % 2 == 0]
+
+    positions = np.concatenate([opening, closing])
+    order = np.argsort(positions, kind="stable")
+    depth = np.cumsum(np.concatenate([
+        np.ones(len(opening), dtype=np.int64),
+        -np.ones(len(closing), dtype=np.int64)
+    ])[order])
 
-    for filename in uploaded_files:
-        json_data = json.load(filename)
-        selected_stats = [
-            {
-                "track": entry.get("master_metadata_track_name"),
-                "artist": entry.get("master_metadata_album_artist_name"),
-                "album": entry.get("master_metadata_album_album_name"),
-                "seconds_played": entry.get("ms_played") / 1000,
-                "scrobble_time": datetime.fromisoformat(entry.get("ts")),
-                "reason_end": entry.get("reason_end"),
-                "skipped": entry.get("skipped"),
-                "track_uri": entry.get("spotify_track_uri")
-            }
-            for entry in json_data
-            if entry.get("ms_played") / 1000 >= 30
-        ]
+    ends = positions[order][(depth == 0) & (order >= len(opening))]
+
+    return int(ends[-1]) if len(ends) else -1
+
+def malformed_file_error(error: msgspec.DecodeError, buffer_offset: int) -> msgspec.DecodeError:
+    "Return the decoding error of a chunk with the byte offset in the whole file."
+
+    offset = re.search(r"\(byte (\d+)\)", str(error))
+
+    # the decoded chunk starts with an added "["
+    position = buffer_offset + (int(offset.group(1)) - 1 if offset else 0)
+
+    return msgspec.DecodeError(f"The history file is malformed near byte {position}: {error}")
+
+def decode_streams(buffer: bytes, buffer_offset: int) -> list[Stream]:
+    """Decode the streams in the buffer as an array, a malformed buffer
+    raises msgspec.DecodeError with the byte offset in the whole file.
+    """
+
+    try:
+        return stream_decoder.decode(b"[" + buffer + b"]")
+    except msgspec.ValidationError:
+        raise
+    except msgspec.DecodeError as error:
+        raise malformed_file_error(error, buffer_offset) from error
+
+def iter_stream_chunks(uploaded_file, chunk_bytes: int=CHUNK_BYTES) -> Iterator[list[Stream]]:
+    """Decode the json array of a history file incrementally,
+    reading at most chunk_bytes at a time and yielding the decoded streams.
+
+    The read bytes are cut after the last "}" and decoded as an array. If that
+    fails, the cut is moved to the end of the last complete stream found by
+    last_stream_end, so every chunk is decoded at most twice. A malformed file
+    raises msgspec.DecodeError with the byte offset of the problem - either when
+    the cut bytes can't be decoded or when no stream ends within MAX_STREAM_BYTES
+    after a chunk, so the buffer never grows much beyond chunk_bytes.
+    """
+
+    buffer = b""
+    # position of the start of the buffer in the file
+    buffer_offset = 0
+    array_started = False
+
+    while True:
+        data = uploaded_file.read(chunk_bytes)
+        buffer += data
+        stripped = buffer.lstrip(b" \t\r\n,")
+        buffer_offset += len(buffer) - len(stripped)
+        buffer = stripped
+
+        if not array_started and buffer:
+            if not buffer.startswith(b"["):
+                raise ValueError("The history file should contain a json array!")
+
+            stripped = buffer[1:].lstrip()
+            buffer_offset += len(buffer) - len(stripped)
+            buffer = stripped
+            array_started = True
+
+        # usually the last "}" closes the last stream, the scanner is only needed
+        # when it was inside a string or a stream or when the file is malformed
+        end = buffer.rfind(b"}")
+        streams = None
+
+        if end != -1:
+            try:
+                streams = stream_decoder.decode(b"[" + buffer[:end + 1] + b"]")
+            except msgspec.ValidationError:
+                raise
+            except msgspec.DecodeError:
+                end = last_stream_end(buffer)
+
+                if end != -1:
+                    streams = decode_streams(buffer[:end + 1], buffer_offset)
+
+        if streams is not None:
+            yield streams
+            buffer = buffer[end + 1:]
+            buffer_offset += end + 1
+        elif len(buffer) > chunk_bytes + MAX_STREAM_BYTES:
+            # decoded once to find where the file is malformed
+            decode_streams(buffer, buffer_offset)
+
+            raise msgspec.DecodeError(
+                f"The history file is malformed near byte {buffer_offset}: "
+                f"no stream ends within {len(buffer)} bytes"
+            )
+
+        if not data:
+            if buffer.strip(b" \t\r\n,]"):
+                raise ValueError("The history file ended in the middle of a stream!")
+
+            return
+
+def parse_file(uploaded_file, chunk_bytes: int | None=CHUNK_BYTES) -> pd.DataFrame:
+    """Return a dataframe of the streams in one json file.
+
+    Keyword arguments:
+    - uploaded_file -- a readable binary file
+    - chunk_bytes (optional) -- parse the file in chunks of this many bytes,
+    None reads and decodes the whole file at once
+    """
 
-        dataframes.append(pd.DataFrame(selected_stats))
+    if chunk_bytes is None:
+        return streams_to_dataframe(stream_decoder.decode(uploaded_file.read()))
 
-    if dataframes:
-        all_dataframes = pd.concat(dataframes)
+    chunks = [
+        streams_to_dataframe(streams)
+        for streams in iter_stream_chunks(uploaded_file, chunk_bytes)
+    ]
+
+    if not chunks:
+        return streams_to_dataframe([])
+
+    return pd.concat(chunks, ignore_index=True)
+
+def parse_file_bytes(data: bytes, chunk_bytes: int | None=CHUNK_BYTES) -> pd.DataFrame:
+    "Parse the contents of one file into a compact dataframe - called in the worker processes."
+    return dtypes.compact_history(parse_file(io.BytesIO(data), chunk_bytes))
+
+def parse_file_path(path: str, chunk_bytes: int | None=CHUNK_BYTES) -> pd.DataFrame:
+    "Parse a file on the disk into a compact dataframe - called in the worker processes."
+
+    with open(path, "rb") as json_file:
+        return dtypes.compact_history(parse_file(json_file, chunk_bytes))
+
+def file_path(uploaded_file) -> str | None:
+    "Return the path of an uploaded file if it is saved on the disk, so a worker can read it."
+
+    path = getattr(getattr(uploaded_file, "stream", uploaded_file), "name", None)
+
+    return path if isinstance(path, str) and os.path.isfile(path) else None
+
+def submit_parse(pool: ProcessPoolExecutor, json_file, chunk_bytes: int | None) -> Future:
+    "Parse a file in the pool - by its path if it has one, otherwise its contents are sent."
+
+    path = file_path(json_file)
+
+    if path is not None:
+        return pool.submit(parse_file_path, path, chunk_bytes)
+
+    return pool.submit(parse_file_bytes, json_file.read(), chunk_bytes)
+
+def get_parse_pool(workers: int) -> ProcessPoolExecutor:
+    """Return the process pool with the given number of workers, started on first use.
+    The workers are spawned so they don't inherit the threads of the web server.
+    """
+
+    with _parse_pools_lock:
+        if workers not in _parse_pools:
+            _parse_pools[workers] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+        return _parse_pools[workers]
+
+def is_zip_upload(uploaded_file) -> bool:
+    "Checks if an uploaded file is a zip export instead of a json file."
+    return (getattr(uploaded_file, "filename", None) or "").lower().endswith(".zip")
+
+def iter_zip_history_files(uploaded_zip) -> Iterator:
+    """Yield the audio streaming history files of a Spotify export zip
+    as file objects which decompress the data while it is being read,
+    so nothing is extracted to the disk or fully into memory.
+    """
+
+    with zipfile.ZipFile(getattr(uploaded_zip, "stream", uploaded_zip)) as archive:
+        for member in archive.infolist():
+            if member.is_dir() or not HISTORY_MEMBER_PATTERN.search(member.filename):
+                continue
+
+            with archive.open(member) as history_file:
+                yield history_file
+
+def parse_json_files(json_files: list, chunk_bytes: int | None, workers: int) -> list[pd.DataFrame]:
+    """Parse json files - in worker processes if there is more than one worker.
+    At most one file per worker is submitted at a time, so the contents of files
+    which aren't on the disk are never all held in memory at once.
+    """
+
+    if workers > 1 and len(json_files) > 1:
+        pool = get_parse_pool(workers)
+        parsed: list[pd.DataFrame | None] = [None] * len(json_files)
+        # future -> index of its file
+        running: dict[Future, int] = {}
+
+        for index, json_file in enumerate(json_files):
+            if len(running) >= workers:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    parsed[running.pop(future)] = future.result()
+
+            running[submit_parse(pool, json_file, chunk_bytes)] = index
+
+        for future, index in running.items():
+            parsed[index] = future.result()
+
+        return parsed
+
+    return [
+        parse_file(json_file, chunk_bytes)
+        for json_file in json_files
+    ]
+
+def parse_uploads(uploaded_files: list, chunk_bytes: int | None, workers: int) -> list[pd.DataFrame]:
+    "Parse json files and Spotify export zips into one dataframe per upload."
+
+    json_files = [uploaded_file for uploaded_file in uploaded_files if not is_zip_upload(uploaded_file)]
+    parsed = dict(zip(map(id, json_files), parse_json_files(json_files, chunk_bytes, workers)))
+
+    for uploaded_zip in filter(is_zip_upload, uploaded_files):
+        parsed[id(uploaded_zip)] = pd.concat(
+            [
+                parse_file(history_file, chunk_bytes)
+                for history_file in iter_zip_history_files(uploaded_zip)
+            ] or [streams_to_dataframe([])],
+            ignore_index=True
+        )
+
+    return [parsed[id(uploaded_file)] for uploaded_file in uploaded_files]
+
+def drop_duplicate_streams(streams: pd.DataFrame, file_ids: np.ndarray) -> tuple[pd.DataFrame, int]:
+    """Drop the streams which are in more than one of the uploaded files,
+    e.g. when an older and a newer export overlap. Every stream is kept from
+    the first file it is in, repeats inside that file are kept too.
+    Return the streams without the duplicates and how many were dropped.
+
+    Keyword arguments:
+    - streams -- the streams of all files in the order of the files
+    - file_ids -- the number of the file of every stream, not decreasing
+    """
+
+    if streams.empty:
+        return streams, 0
+
+    groups = streams.groupby(STREAM_KEY, observed=True, dropna=False, sort=False).ngroup().to_numpy()
+    # the groups are numbered in the order of their first stream, which is in their first file
+    _, first_rows = np.unique(groups, return_index=True)
+    duplicated = file_ids != file_ids[first_rows][groups]
+    dropped = int(duplicated.sum())
+
+    if dropped:
+        streams = streams[~duplicated].reset_index(drop=True)
+
+    return streams, dropped
+
+def parse_file_data(
+        uploaded_files: dict,
+        chunk_bytes: int | None=CHUNK_BYTES,
+        workers: int=PARSE_WORKERS
+    ) -> pd.DataFrame:
+    """
+        Return a dataframe with all data in the uploads folder ordered by time.
+        The uploads can be json history files or whole Spotify export zips.
+        Every file is parsed in chunks of chunk_bytes (None - all at once).
+        With more than one worker json files are parsed in parallel processes,
+        the files inside a zip are streamed in this process one by one.
+        Files which were parsed before are loaded from the parse cache.
+        Streams which are in more than one file are kept once and their
+        number is saved in the "duplicate_streams" attribute of the dataframe.
+    """
+
+    if not uploaded_files:
+        return pd.DataFrame()
+
+    if not parse_cache.enabled():
+        dataframes = parse_uploads(uploaded_files, chunk_bytes, workers)
     else:
-        all_dataframes = pd.DataFrame()
+        keys = [parse_cache.content_hash(uploaded_file) for uploaded_file in uploaded_files]
+        cached = {key: parse_cache.load(key) for key in set(keys)}
+
+        missing = {
+            key: uploaded_file
+            for key, uploaded_file in zip(keys, uploaded_files)
+            if cached[key] is None
+        }
+
+        for key, streams in zip(missing, parse_uploads(list(missing.values()), chunk_bytes, workers)):
+            parse_cache.store(key, streams)
+            cached[key] = streams
+
+        dataframes = [cached[key] for key in keys]
+
+    file_ids = np.repeat(np.arange(len(dataframes)), [len(streams) for streams in dataframes])
+    all_dataframes = dtypes.concat_histories(dataframes)
+    all_dataframes, dropped = drop_duplicate_streams(all_dataframes, file_ids)
+    all_dataframes = all_dataframes.sort_values("scrobble_time", kind="stable", ignore_index=True)
+    all_dataframes.attrs["duplicate_streams"] = dropped
 
     return all_dataframes
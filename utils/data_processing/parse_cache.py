@@ -0,0 +1,145 @@
+"""
+    A disk cache of parsed Spotify history uploads keyed by the hash of their contents.
+    Every parsed file is stored as a directory of .npy columns - text columns
+    as integer codes and their distinct values - which are loaded memory-mapped.
+    The least recently used entries are removed once the cache outgrows its budget.
+"""
+
+import os
+import shutil
+import hashlib
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from utils.cache import evict_least_recently_used
+
+CACHE_DIR = os.getenv(
+    "SPOTIFY_PARSE_CACHE_DIR",
+    os.path.join(os.getcwd(), "parse_cache")
+)
+
+# 0 turns the cache off
+CACHE_MAX_BYTES = int(os.getenv("SPOTIFY_PARSE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# changes whenever the parsed columns change, so old entries are never loaded
+CACHE_VERSION = "2"
+
+HASH_BLOCK_BYTES = 1024 * 1024
+
+TEXT_COLUMNS = ["track", "artist", "album", "reason_end", "track_uri"]
+
+_cache_lock = threading.Lock()
+
+def enabled() -> bool:
+    "Checks if parsed uploads are cached."
+    return CACHE_MAX_BYTES > 0
+
+def content_hash(uploaded_file) -> str:
+    "Return the hash of a file's contents and rewind the file."
+
+    digest = hashlib.blake2b(CACHE_VERSION.encode(), digest_size=20)
+
+    while block := uploaded_file.read(HASH_BLOCK_BYTES):
+        digest.update(block)
+
+    uploaded_file.seek(0)
+
+    return digest.hexdigest()
+
+def entry_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key)
+
+def write_columns(path: str, streams: pd.DataFrame) -> None:
+    "Save every column of the parsed streams as one or two .npy files."
+
+    for column in TEXT_COLUMNS:
+        codes, values = pd.factorize(streams[column])
+        np.save(os.path.join(path, f"{column}.codes.npy"), codes.astype(np.int32))
+        np.save(os.path.join(path, f"{column}.values.npy"), np.asarray(values, dtype=str))
+
+    np.save(os.path.join(path, "seconds_played.npy"), streams["seconds_played"].to_numpy(np.float32))
+    np.save(
+        os.path.join(path, "scrobble_time.npy"),
+        pd.DatetimeIndex(streams["scrobble_time"]).as_unit("ns").asi8
+    )
+    # -1 is a missing value
+    np.save(
+        os.path.join(path, "skipped.npy"),
+        streams["skipped"].map({True: 1, False: 0}).fillna(-1).to_numpy(np.int8)
+    )
+
+def read_columns(path: str) -> pd.DataFrame:
+    """Load the parsed streams saved by write_columns as a compact history -
+    text columns are categoricals made straight from the saved codes.
+    """
+
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+    columns = {}
+
+    for column in TEXT_COLUMNS:
+        # code -1 is a missing value
+        columns[column] = pd.Categorical.from_codes(
+            load(f"{column}.codes"),
+            categories=pd.Index(load(f"{column}.values"), dtype=object)
+        )
+
+    columns["seconds_played"] = load("seconds_played")
+    columns["scrobble_time"] = pd.to_datetime(load("scrobble_time"), unit="ns", utc=True).as_unit("s")
+
+    skipped = load("skipped")
+    columns["skipped"] = pd.arrays.BooleanArray(skipped == 1, skipped < 0)
+
+    streams = pd.DataFrame(columns, copy=False)
+
+    return streams[["track", "artist", "album", "seconds_played",
+                    "scrobble_time", "reason_end", "skipped", "track_uri"]]
+
+def load(key: str) -> pd.DataFrame | None:
+    "Return the cached parsed streams of a file or None."
+
+    path = entry_path(key)
+
+    try:
+        streams = read_columns(path)
+        # the modification time of an entry is its last use
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+
+    return streams
+
+def store(key: str, streams: pd.DataFrame) -> None:
+    "Cache the parsed streams of a file and evict old entries if needed."
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temporary_path = os.path.join(CACHE_DIR, f".{key}.{uuid.uuid4().hex}")
+    os.mkdir(temporary_path)
+
+    try:
+        write_columns(temporary_path, streams)
+        os.rename(temporary_path, entry_path(key))
+    except OSError:
+        # another request has just cached the same file
+        shutil.rmtree(temporary_path, ignore_errors=True)
+
+    evict()
+
+def entry_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+def evict(max_bytes: int | None=None) -> None:
+    "Remove the least recently used entries until the cache fits into max_bytes."
+
+    with _cache_lock:
+        evict_least_recently_used(
+            CACHE_DIR,
+            CACHE_MAX_BYTES if max_bytes is None else max_bytes,
+            # entries which are being written are hidden
+            is_entry=lambda entry: entry.is_dir() and not entry.name.startswith("."),
+            entry_size=lambda entry: entry_size(entry.path)
+        )
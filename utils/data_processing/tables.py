@@ -0,0 +1,55 @@
+"""
+    The tables of an analysis in a form which can be kept
+    in the result store, and the pages of them which are shown in see more views.
+"""
+
+import math
+
+import pandas as pd
+
+PAGE_SIZE = 50
+
+def table_to_lists(table: pd.DataFrame) -> dict:
+    "Return a table as plain lists of its columns, index and rows - dates in the index as ISO strings."
+
+    index = table.index
+
+    if isinstance(index, pd.DatetimeIndex):
+        index = index.strftime("%Y-%m-%dT%H:%M:%S")
+
+    return {
+        "columns": list(table.columns),
+        "index": index.tolist(),
+        "data": table.to_numpy(dtype=object).tolist()
+    }
+
+def table_from_lists(table_data: dict) -> pd.DataFrame:
+    "Return the table saved by table_to_lists."
+    return pd.DataFrame(table_data["data"], index=table_data["index"], columns=table_data["columns"])
+
+def table_page(
+        table: pd.DataFrame,
+        page: int=1,
+        sort_by: str | None=None,
+        descending: bool=True,
+        page_size: int=PAGE_SIZE
+    ) -> tuple[pd.DataFrame, int, int]:
+    """Return one page of a table and keep the rank of every row as its index.
+
+    Keyword arguments:
+    - table -- the whole table
+    - page (optional) -- the number of the page starting from 1,
+    pages out of range show the first or the last page
+    - sort_by (optional) -- the column to sort by, the table order by default
+    - descending (optional) -- sort from the largest value
+    - page_size (optional) -- the number of rows on one page
+    Return: the rows of the page, the number of the page and the number of all pages
+    """
+
+    if sort_by in table.columns:
+        table = table.sort_values(sort_by, ascending=not descending, kind="stable")
+
+    pages = max(1, math.ceil(len(table) / page_size))
+    page = min(max(page, 1), pages)
+
+    return table.iloc[(page - 1) * page_size : page * page_size], page, pages
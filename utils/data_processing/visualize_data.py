@@ -14,6 +14,7 @@ from bokeh.embed import components
 
 from utils import validation
 from utils.lastfm import lastfm_validation
+from utils.data_processing import aggregate, tables
 
 TOOLS="wheel_zoom,box_zoom,reset,save"
 
@@ -40,10 +41,11 @@ def get_top_scrobbles_chart(
 
     if is_custom:
         if data_type == "artists":
-            x_range = top_data["artist"]
+            x_range = top_data["artist"].astype(str)
         else:
             top_data = top_data.assign(
-                artist_and_name=top_data["artist"] + " - " + top_data[data_type[:-1]]
+                artist_and_name=top_data["artist"].astype(str) + " - " \
+                    + top_data[data_type[:-1]].astype(str)
             )
             x_range = top_data["artist_and_name"]
     else:
@@ -89,26 +91,11 @@ def get_html_table(dataframe: pd.DataFrame | pd.Series, top_items: int | None=No
 
     return dataframe.to_html(classes=("table", "table-striped", "align-middle"))
 
-def group_by_timeframe(df: pd.DataFrame, start_date: date, end_date: date) -> pd.DataFrame:
-    """Group dataframe into time periods for 
-    further processing in line graphs.
-    """
-
-    days_difference = (end_date - start_date).days
-
-    if days_difference <= 15:
-        df["time_group"] = df["scrobble_time"].dt.date
-    elif days_difference <= 31:
-        df["time_group"] = df["scrobble_time"].dt.to_period("W").dt.to_timestamp()
-    else:
-        df["time_group"] = df["scrobble_time"].dt.to_period("M").dt.to_timestamp()
-
-    return df
-
 def get_cumulative_scrobble_stats(
     dataframe: pd.DataFrame,
     start_date: date,
-    end_date: date
+    end_date: date,
+    bucket: str="adaptive"
     ) -> tuple[str, str]:
     """Return div and script of cumulative scrobbling data
     
@@ -116,11 +103,22 @@ def get_cumulative_scrobble_stats(
     - dataframe -- the custom track data from Last.fm
     - start_date -- start date
     - end_date -- end_date 
+    - bucket (optional) -- D | W | M | adaptive - the time period of one point
     """
 
-    group_by_timeframe(dataframe, start_date, end_date)
+    cumulative = aggregate.cumulative_counts(dataframe, bucket, start_date, end_date)
+
+    return get_cumulative_chart(cumulative, start_date, end_date)
+
+def get_cumulative_chart(cumulative: pd.DataFrame, start_date: date, end_date: date) -> tuple[str, str]:
+    """Return div and script of a graph of the series from aggregate.cumulative_counts.
+
+    Keyword arguments:
+    - cumulative -- dataframe indexed by time_group with artist, track and album columns
+    - start_date -- start date
+    - end_date -- end_date
+    """
 
-    dataframe["time_group"] = pd.to_datetime(dataframe["time_group"])
     start_datetime = datetime(start_date.year, start_date.month, start_date.day)
     end_datetime = datetime(end_date.year, end_date.month, end_date.day)
 
@@ -135,21 +133,12 @@ def get_cumulative_scrobble_stats(
         )
 
     colors = {"artist": "blue", "track": "red", "album": "green"}
+    source = ColumnDataSource(cumulative.reset_index())
 
     for data_type, color in colors.items():
-        category_df = dataframe.groupby(
-                ["time_group", data_type]
-            ).size().reset_index(name="scrobble_count")
-
-        category_df = category_df.sort_values("time_group")
-        category_df = category_df.groupby("time_group") \
-            .size().reset_index(name="scrobbles")
-        category_df["cumulative_scrobbles"] = category_df["scrobbles"].cumsum()
-
-        source=ColumnDataSource(category_df)
         plot.line(
             x="time_group",
-            y="cumulative_scrobbles",
+            y=data_type,
             source=source,
             line_width=2,
             color=color,
@@ -162,6 +151,50 @@ def get_cumulative_scrobble_stats(
 
     return script, div
 
+def get_analysis_views(result: dict) -> dict:
+    """Render the tables and graphs of an analysis from its saved result.
+
+    Keyword arguments:
+    - result -- the result of an analysis with the tables, the overall stats,
+    the cumulative series and the similar artists
+    Return: the short tables, graphs, custom graphs, overall stats
+    and similar artists for the analysis templates
+    """
+
+    views = {
+        "short_tables": {},
+        "graphs": {},
+        "custom_graphs": {},
+        "overall_stats": None,
+        "similar_artists": result.get("similar_artists", [])
+    }
+
+    for data_type, table_data in result["tables"].items():
+        table = tables.table_from_lists(table_data)
+        views["short_tables"][data_type] = get_html_table(table, 15)
+
+        chart = get_top_scrobbles_chart(data_type, table, result["is_custom"])
+
+        if chart:
+            script, div = chart
+            views["graphs"][data_type] = {"script": script, "div": div}
+
+    if result.get("overall_stats"):
+        views["overall_stats"] = get_html_table(tables.table_from_lists(result["overall_stats"]))
+
+    if result.get("cumulative"):
+        cumulative = tables.table_from_lists(result["cumulative"])
+        cumulative.index = pd.to_datetime(cumulative.index).rename("time_group")
+
+        script, div = get_cumulative_chart(
+            cumulative,
+            date.fromisoformat(result["start_date"]),
+            date.fromisoformat(result["end_date"])
+        )
+        views["custom_graphs"]["cumulative"] = {"script": script, "div": div}
+
+    return views
+
 def get_total_stats_from_lastfm(
         username: str,
         lastfm_data: dict[str, pd.DataFrame],
@@ -0,0 +1,239 @@
+"""
+    Runs analyses in the background so the requests which start them
+    return right away, and keeps the progress of every job for the loading page.
+    - LocalJobRunner - a thread pool inside the web server process
+    - RedisJobQueue - jobs are queued in Redis and run by separate worker processes
+    (flask --app main.py jobs-worker)
+
+    A job is a registered task which gets a JobProgress and its arguments
+    and returns the id of the saved analysis result or None. Tasks run inside
+    a request context of their own, the messages they flash are kept with the job.
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import msgspec
+import redis
+from flask import Flask, flash, get_flashed_messages
+
+from utils.cache import REDIS_URL
+
+JOB_BACKEND = os.getenv("JOB_BACKEND", "thread")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# the state of a finished job is kept for this many seconds
+JOB_STATE_MAX_AGE = int(os.getenv("JOB_STATE_MAX_AGE", str(60 * 60)))
+
+# task name -> function
+TASKS: dict[str, Callable] = {}
+
+def task(function: Callable) -> Callable:
+    "Register a function which can be run as a job."
+    TASKS[function.__name__] = function
+    return function
+
+def new_job_state() -> dict:
+    return {
+        "status": "running",
+        "progress": 0,
+        "stage": "",
+        "current_page": 0,
+        "total_pages": 0,
+        "analysis_id": None,
+        "messages": [],
+        "updated": time.time()
+    }
+
+class JobProgress:
+    """The progress of a job made of steps - e.g. the top tracks, albums
+    and artists - which each fetch a number of pages.
+    """
+
+    def __init__(self, update: Callable[[dict], None], steps: int=1):
+        self.update = update
+        self.steps = steps
+        self.step = 0
+
+    def start_step(self, step: int, stage: str) -> None:
+        "Start the step with the given index."
+        self.step = step
+        self.update({
+            "stage": stage,
+            "progress": int(100 * step / self.steps),
+            "current_page": 0,
+            "total_pages": 0
+        })
+
+    def pages(self, fetched_pages: int, total_pages: int) -> None:
+        "Report the fetched pages of the current step, can be passed as progress to get_data."
+        self.update({
+            "progress": int(100 * (self.step + fetched_pages / max(total_pages, 1)) / self.steps),
+            "current_page": fetched_pages,
+            "total_pages": total_pages
+        })
+
+def run_job(app: Flask, task_name: str, args: list, update: Callable[[dict], None]) -> None:
+    "Run a task in a request context of its own and save its outcome with update."
+
+    with app.test_request_context():
+        try:
+            analysis_id = TASKS[task_name](JobProgress(update), *args)
+        except Exception: # pylint: disable=broad-exception-caught
+            app.logger.exception("Job %s failed", task_name)
+            flash("Something went wrong during the analysis, please try again!")
+            analysis_id = None
+
+        messages = get_flashed_messages()
+
+    update({
+        "status": "complete" if analysis_id else "failed",
+        "progress": 100,
+        "analysis_id": analysis_id,
+        "messages": messages
+    })
+
+class LocalJobRunner:
+    "Jobs run by a pool of threads in this process."
+
+    def __init__(self, workers: int, max_age: float):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.max_age = max_age
+        self.states: dict[str, dict] = {}
+        self.futures: dict[str, Future] = {}
+        # job key -> id of the running job
+        self.running_keys: dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.app: Flask | None = None
+
+    def init_app(self, app: Flask) -> None:
+        self.app = app
+
+    def submit(self, task_name: str, *args, key: str | None=None) -> str:
+        """Start a job and return its id. If a job with the same key
+        is still running, no new job is started and its id is returned.
+        """
+
+        job_id = uuid.uuid4().hex
+
+        with self.lock:
+            if key in self.running_keys:
+                return self.running_keys[key]
+
+            self.remove_old_states()
+            self.states[job_id] = new_job_state()
+
+            if key:
+                self.running_keys[key] = job_id
+
+        def update(changes: dict) -> None:
+            with self.lock:
+                self.states[job_id].update(changes, updated=time.time())
+
+                if changes.get("status", "running") != "running" and key:
+                    self.running_keys.pop(key, None)
+
+        self.futures[job_id] = self.executor.submit(run_job, self.app, task_name, list(args), update)
+
+        return job_id
+
+    def status(self, job_id: str) -> dict | None:
+        "Return the state of a job or None if there is no such job."
+        with self.lock:
+            state = self.states.get(job_id)
+
+            return dict(state) if state else None
+
+    def remove_old_states(self) -> None:
+        oldest_allowed = time.time() - self.max_age
+
+        for job_id, state in list(self.states.items()):
+            if state["status"] != "running" and state["updated"] < oldest_allowed:
+                del self.states[job_id]
+                self.futures.pop(job_id, None)
+
+class RedisJobQueue:
+    """Jobs queued in Redis and run by worker processes, so every
+    web server process can start jobs and report their progress.
+    The result store has to be shared by the workers too (e.g. the redis backend)
+    and so does the folder of the uploaded files (upload_store.UPLOAD_DIR).
+    """
+
+    def __init__(self, url: str, max_age: float, prefix: str="music-analyzer:job:"):
+        self.redis = redis.Redis.from_url(url)
+        self.max_age = max(1, int(max_age))
+        self.prefix = prefix
+        self.app: Flask | None = None
+
+    def init_app(self, app: Flask) -> None:
+        self.app = app
+
+    def save_state(self, job_id: str, state: dict) -> None:
+        self.redis.set(self.prefix + "state:" + job_id, json.dumps(state), ex=self.max_age)
+
+    def submit(self, task_name: str, *args, key: str | None=None) -> str:
+        """Queue a job and return its id. If a job with the same key
+        is still queued or running, its id is returned instead.
+        """
+
+        job_id = uuid.uuid4().hex
+
+        if key and not self.redis.set(self.prefix + "key:" + key, job_id, nx=True, ex=self.max_age):
+            running_job_id = self.redis.get(self.prefix + "key:" + key)
+
+            if running_job_id:
+                return running_job_id.decode()
+
+        self.save_state(job_id, new_job_state())
+        self.redis.rpush(self.prefix + "queue", msgspec.msgpack.encode([job_id, task_name, list(args), key]))
+
+        return job_id
+
+    def status(self, job_id: str) -> dict | None:
+        "Return the state of a job or None if there is no such job."
+        try:
+            state = self.redis.get(self.prefix + "state:" + job_id)
+        except redis.RedisError:
+            return None
+
+        return None if state is None else json.loads(state)
+
+    def work(self) -> None:
+        "Run the queued jobs one after another until the process is stopped."
+
+        while True:
+            _, message = self.redis.blpop([self.prefix + "queue"])
+            job_id, task_name, args, key = msgspec.msgpack.decode(message)
+            state = new_job_state()
+
+            def update(changes: dict, job_id: str=job_id, state: dict=state, key: str | None=key) -> None:
+                state.update(changes, updated=time.time())
+                self.save_state(job_id, state)
+
+                if state["status"] != "running" and key:
+                    self.redis.delete(self.prefix + "key:" + key)
+
+            run_job(self.app, task_name, args, update)
+
+def create_job_runner(backend: str, workers: int, max_age: float, redis_url: str) \
+-> LocalJobRunner | RedisJobQueue:
+    """Return a job runner for the given backend name.
+
+    Keyword arguments:
+    - backend -- thread | redis
+    - workers -- number of threads of the thread backend
+    - max_age -- seconds the state of a finished job is kept
+    - redis_url -- url of the Redis server for the redis backend
+    """
+
+    match backend:
+        case "redis":
+            return RedisJobQueue(redis_url, max_age)
+        case _:
+            return LocalJobRunner(workers, max_age)
+
+job_runner = create_job_runner(JOB_BACKEND, JOB_WORKERS, JOB_STATE_MAX_AGE, REDIS_URL)
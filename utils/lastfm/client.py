@@ -0,0 +1,194 @@
+"""
+    The shared client for all Last.fm API calls
+    and the single place where it is configured.
+"""
+
+import os
+import json
+import time
+import hashlib
+
+import dotenv
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.cache import create_cache, LRUCache, RedisCache, REDIS_URL
+from utils.rate_limit import TokenBucket, MAX_RETRIES, backoff_delay, retry_after_seconds
+
+dotenv.load_dotenv()
+
+ROOT_URL = os.getenv("LASTFM_ROOT_URL", "http://ws.audioscrobbler.com/2.0/")
+LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
+REQUEST_TIMEOUT = float(os.getenv("LASTFM_REQUEST_TIMEOUT", "600"))
+MAX_WORKERS = int(os.getenv("LASTFM_MAX_WORKERS", "8"))
+POOL_SIZE = int(os.getenv("LASTFM_POOL_SIZE", "16"))
+# Last.fm allows around 5 calls per second averaged over 5 minutes
+RATE_LIMIT = float(os.getenv("LASTFM_RATE_LIMIT", "5"))
+RATE_LIMIT_BURST = float(os.getenv("LASTFM_RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_ERROR = 29
+
+CACHE_BACKEND = os.getenv("LASTFM_CACHE_BACKEND", "memory")
+CACHE_MAX_BYTES = int(os.getenv("LASTFM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# time to live of the cached responses in seconds, methods which aren't here aren't cached
+CACHE_TTL = {
+    "artist.getSimilar": 7 * DAY,
+    "track.getInfo": 7 * DAY,
+    "user.getinfo": 10 * MINUTE,
+    "user.gettoptracks": HOUR,
+    "user.gettopalbums": HOUR,
+    "user.gettopartists": HOUR,
+    "user.getrecenttracks": DAY
+}
+# recent tracks pages which can still change - open time ranges and "now playing"
+LIVE_PAGE_TTL = 30
+
+def cache_ttl(method: str, params: dict, response_dict: dict) -> float:
+    "Return for how many seconds a response of a method can be cached."
+
+    if method != "user.getrecenttracks":
+        return CACHE_TTL.get(method, 0)
+
+    tracks = response_dict.get("recenttracks", {}).get("track", [])
+    now_playing = any("@attr" in track for track in tracks)
+
+    if now_playing or int(params.get("to", time.time())) >= time.time():
+        return LIVE_PAGE_TTL
+
+    return CACHE_TTL[method]
+
+def cache_key(method: str, params: dict) -> str:
+    "Return the cache key of a call - the api key is not part of it."
+    call = json.dumps([method, sorted(params.items())], default=str)
+
+    return "lastfm:" + hashlib.sha256(call.encode()).hexdigest()
+
+def is_rate_limited(response: requests.Response) -> bool:
+    "Checks if Last.fm refused a call because of the rate limit (HTTP 429 or error 29)."
+
+    if response.status_code == 429:
+        return True
+
+    if response.ok and not response.content.lstrip().startswith(b'{"error"'):
+        return False
+
+    try:
+        return response.json().get("error") == RATE_LIMIT_ERROR
+    except requests.exceptions.JSONDecodeError:
+        return False
+
+def cached_response(content: bytes) -> requests.Response:
+    "Build a response object from cached content."
+    response = requests.Response()
+    response.status_code = 200
+    response.encoding = "utf-8"
+    response._content = content # pylint: disable=protected-access
+
+    return response
+
+class LastfmClient:
+    """Sends requests to the Last.fm API through one
+    keep-alive session with a pool of reusable connections.
+    """
+
+    def __init__(
+            self,
+            api_key: str | None,
+            root_url: str=ROOT_URL,
+            timeout: float=REQUEST_TIMEOUT,
+            pool_size: int=POOL_SIZE,
+            cache: LRUCache | RedisCache | None=None,
+            rate_limiter: TokenBucket | None=None
+        ):
+        self.api_key = api_key
+        self.root_url = root_url
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(
+            self,
+            method: str,
+            params: dict | None=None,
+            timeout: float | None=None
+        ) -> requests.Response:
+        """Call a Last.fm API method and return the response.
+        Successful responses are served from the cache while they are fresh,
+        calls refused because of the rate limit are retried with a backoff.
+
+        Keyword arguments:
+        - method -- the API method, for example user.getinfo
+        - params (optional) -- the parameters of the method
+        - timeout (optional) -- timeout in seconds for this call only
+        """
+
+        params = params or {}
+        key = cache_key(method, params)
+
+        if self.cache is not None and method in CACHE_TTL:
+            content = self.cache.get(key)
+
+            if content is not None:
+                return cached_response(content)
+
+        request_params = {
+            "method": method,
+            **params,
+            "api_key": self.api_key,
+            "format": "json"
+        }
+
+        for attempt in range(MAX_RETRIES + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            response = self.session.get(
+                self.root_url,
+                params=request_params,
+                timeout=self.timeout if timeout is None else timeout
+            )
+
+            if attempt == MAX_RETRIES or not is_rate_limited(response):
+                break
+
+            delay = backoff_delay(attempt, retry_after_seconds(response.headers))
+
+            if self.rate_limiter is not None:
+                # all threads wait, not only the one which was refused
+                self.rate_limiter.pause(delay)
+            else:
+                time.sleep(delay)
+
+        if self.cache is not None and method in CACHE_TTL and response.ok:
+            self._store(method, params, key, response)
+
+        return response
+
+    def _store(self, method: str, params: dict, key: str, response: requests.Response) -> None:
+        try:
+            response_dict = response.json()
+        except requests.exceptions.JSONDecodeError:
+            return
+
+        if "error" in response_dict:
+            return
+
+        ttl = cache_ttl(method, params, response_dict)
+
+        if ttl > 0:
+            self.cache.set(key, response.content, ttl)
+
+lastfm_client = LastfmClient(
+    LASTFM_API_KEY,
+    cache=create_cache(CACHE_BACKEND, CACHE_MAX_BYTES, REDIS_URL),
+    rate_limiter=TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST)
+)
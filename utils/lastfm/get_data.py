@@ -4,26 +4,84 @@
     to be visualized and processed.
 """
 
-import os
+import threading
+from collections.abc import Callable
+from typing import Any
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import requests
-import dotenv
 import pandas as pd
 
 from utils import validation
+from utils.data_processing import dtypes
 from utils.lastfm import lastfm_validation
+from utils.lastfm.client import lastfm_client, MAX_WORKERS
 
-dotenv.load_dotenv()
+SIMILAR_ARTIST_MIN_MATCH = 0.7
 
-REQUEST_TIMEOUT = 600
-LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
-ROOT_URL = "http://ws.audioscrobbler.com/2.0/"
+# reports the number of fetched pages out of all pages
+Progress = Callable[[int, int], None]
+
+def fetch_all(
+        fetch: Callable[[Any], requests.Response],
+        items: list,
+        max_workers: int=MAX_WORKERS
+    ) -> list[requests.Response]:
+    """Call fetch for every item with at most max_workers
+    concurrent requests and return the responses in the order of items.
+    """
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [fetch(item) for item in items]
+
+    # the responses are only validated afterwards by the caller
+    # because flash needs the request context of the main thread
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(fetch, items))
+
+def fetch_remaining_pages(
+        fetch_page: Callable[[int], requests.Response],
+        total_pages: int,
+        max_workers: int=MAX_WORKERS,
+        progress: Progress | None=None
+    ) -> list[requests.Response]:
+    """Fetch pages 2..total_pages and return the responses in page order.
+
+    Keyword arguments:
+    - fetch_page -- function which requests a single page by its number
+    - total_pages -- the totalPages value returned with the first page
+    - max_workers (optional) -- upper bound of concurrent requests,
+    1 fetches the pages one after another
+    - progress (optional) -- called with the number of fetched pages
+    (the first one included) and total_pages after every page
+    """
+
+    if progress is None:
+        return fetch_all(fetch_page, list(range(2, total_pages + 1)), max_workers)
+
+    fetched_pages = 1
+    lock = threading.Lock()
+    progress(fetched_pages, total_pages)
+
+    def fetch_and_report(page: int) -> requests.Response:
+        nonlocal fetched_pages
+        response = fetch_page(page)
+
+        with lock:
+            fetched_pages += 1
+            progress(fetched_pages, total_pages)
+
+        return response
+
+    return fetch_all(fetch_and_report, list(range(2, total_pages + 1)), max_workers)
 
 def top_data_predefined_period(
         username: str,
         data_type: str,
-        time_period: str
+        time_period: str,
+        max_workers: int=MAX_WORKERS,
+        progress: Progress | None=None
     ) -> pd.DataFrame:
     """Returns a dataframe of the scrobbles
        based on a predefined time period.
@@ -32,6 +90,9 @@ def top_data_predefined_period(
     - username -- description
     - data_type -- tracks | albums | artists
     - time_period -- 7day | 1month | 3month | 6month | 12month | overall
+    - max_workers (optional) -- how many pages to fetch concurrently
+    after the first one, 1 fetches them sequentially
+    - progress (optional) -- called with the fetched and total pages
     """
 
     if not (
@@ -41,22 +102,27 @@ def top_data_predefined_period(
     ):
         return pd.DataFrame()
 
-    page = 1
-    list_tracks = []
-
-    while True:
+    def fetch_page(page: int) -> requests.Response:
         params = {
-            "method": "user.gettop" + data_type,
             "user": username,
-            "api_key": LASTFM_API_KEY,
-            "format": "json",
             "period": time_period,
             "limit": 200,
             "page": page
         }
 
-        response = requests.get(ROOT_URL, params=params, timeout=REQUEST_TIMEOUT)
+        return lastfm_client.get("user.gettop" + data_type, params)
+
+    first_response = fetch_page(1)
+
+    if not lastfm_validation.check_lastfm_response(first_response):
+        return pd.DataFrame()
+
+    total_pages = int(first_response.json()["top" + data_type]["@attr"]["totalPages"])
+    responses = [first_response] + fetch_remaining_pages(fetch_page, total_pages, max_workers, progress)
+
+    list_tracks = []
 
+    for response in responses:
         if not lastfm_validation.check_lastfm_response(response):
             return pd.DataFrame()
 
@@ -72,138 +138,213 @@ def top_data_predefined_period(
             for entry in response_dict["top" + data_type][data_type[:-1]]
         ]
 
-        total_pages = response_dict["top" + data_type]["@attr"]["totalPages"]
-
-        if page >= int(total_pages):
-            break
-
-        page += 1
-
     df_tracks = pd.DataFrame(list_tracks)
     df_tracks.dropna(axis=1, inplace=True)
     df_tracks.index += 1
 
     return df_tracks
 
-def recent_tracks_by_custom_dates(
+def recent_scrobbles(
     username: str,
-    start_date: str,
-    end_date: str
-    ) -> pd.DataFrame:
-    """Returns a dataframe of the tracks 
-    scrobbled between start_date and end_date.
-    
+    start_timestamp: int,
+    end_timestamp: int,
+    max_workers: int=MAX_WORKERS,
+    progress: Progress | None=None
+    ) -> list[dict] | None:
+    """Returns the scrobbles of a user between two unix timestamps
+    (newest first) or None if Last.fm returned an error.
+
+    The pages after the first one are fetched concurrently and then merged
+    in page order. Scrobbles are deduplicated on (uts, track, artist) since
+    the pages can shift while new scrobbles are coming in.
+
     Keyword arguments:
     - username -- Last.fm username
-    - start_date -- start date
-    - end_date -- end_date
+    - start_timestamp -- unix timestamp of the start of the range
+    - end_timestamp -- unix timestamp of the end of the range
+    - max_workers (optional) -- upper bound of concurrent page requests
+    - progress (optional) -- called with the fetched and total pages
     """
 
-    start_datetime = datetime.fromisoformat(start_date + "T00:00:00")
-    start_timestamp = int(start_datetime.timestamp())
-
-    end_datetime = datetime.fromisoformat(end_date + "T23:59:59")
-    end_datetime.replace(hour=23, minute=59, second=59)
-    end_timestamp = int(end_datetime.timestamp())
-
-    page = 1
-    list_response = []
-
-    while True:
+    def fetch_page(page: int) -> requests.Response:
         params = {
-            "method": "user.getrecenttracks",
             "user": username,
-            "api_key": LASTFM_API_KEY,
-            "format": "json",
             "from": start_timestamp,
             "to": end_timestamp,
             "limit": 200,
             "page": page
         }
 
-        response = requests.get(ROOT_URL, params=params, timeout=REQUEST_TIMEOUT)
-        response_dict = response.json()
+        return lastfm_client.get("user.getrecenttracks", params)
 
-        if not lastfm_validation.check_lastfm_response(response) \
-            or response_dict.get("recenttracks").get("@attr").get("total") == "0":
-            return pd.DataFrame()
+    first_response = fetch_page(1)
 
-        list_response += [
-            {
-                "track": track["name"], 
+    if not lastfm_validation.check_lastfm_response(first_response):
+        return None
+
+    attributes = first_response.json()["recenttracks"]["@attr"]
+
+    if attributes.get("total") == "0":
+        return []
+
+    total_pages = int(attributes["totalPages"])
+    responses = [first_response] + fetch_remaining_pages(fetch_page, total_pages, max_workers, progress)
+
+    scrobbles = {}
+
+    for response in responses:
+        if not lastfm_validation.check_lastfm_response(response):
+            return None
+
+        for track in response.json()["recenttracks"]["track"]:
+            # the track which is playing right now has no date yet
+            if "@attr" in track.keys():
+                continue
+
+            scrobble = {
+                "uts": int(track["date"]["uts"]),
+                "track": track["name"],
                 "artist": track["artist"]["#text"],
-                "album": track["album"]["#text"],
-                "scrobble_time": datetime.fromtimestamp(int(track["date"]["uts"]))
+                "album": track["album"]["#text"]
             }
-            for track in response_dict["recenttracks"]["track"]
-            if "@attr" not in track.keys()
-        ]
+            scrobbles.setdefault((scrobble["uts"], scrobble["track"], scrobble["artist"]), scrobble)
+
+    return list(scrobbles.values())
+
+def scrobbles_to_dataframe(scrobbles: list[dict]) -> pd.DataFrame:
+    "Turns scrobbles returned by recent_scrobbles into a dataframe."
+
+    return dtypes.compact_history(pd.DataFrame([
+        {
+            "track": scrobble["track"],
+            "artist": scrobble["artist"],
+            "album": scrobble["album"],
+            "scrobble_time": datetime.fromtimestamp(scrobble["uts"])
+        }
+        for scrobble in scrobbles
+    ]))
+
+def custom_dates_to_timestamps(start_date: str, end_date: str) -> tuple[int, int]:
+    "Returns the unix timestamps of the start of start_date and the end of end_date."
+
+    start_datetime = datetime.fromisoformat(start_date + "T00:00:00")
+    end_datetime = datetime.fromisoformat(end_date + "T23:59:59")
+
+    return int(start_datetime.timestamp()), int(end_datetime.timestamp())
+
+def recent_tracks_by_custom_dates(
+    username: str,
+    start_date: str,
+    end_date: str,
+    max_workers: int=MAX_WORKERS,
+    progress: Progress | None=None
+    ) -> pd.DataFrame:
+    """Returns a dataframe of the tracks 
+    scrobbled between start_date and end_date.
+    
+    Keyword arguments:
+    - username -- Last.fm username
+    - start_date -- start date
+    - end_date -- end_date
+    - max_workers (optional) -- upper bound of concurrent page requests
+    - progress (optional) -- called with the fetched and total pages
+    """
 
-        total_pages = response_dict["recenttracks"]["@attr"]["totalPages"]
+    start_timestamp, end_timestamp = custom_dates_to_timestamps(start_date, end_date)
+    scrobbles = recent_scrobbles(username, start_timestamp, end_timestamp, max_workers, progress)
 
-        if page >= int(total_pages):
-            break
+    if not scrobbles:
+        return pd.DataFrame()
 
-        page += 1
+    return scrobbles_to_dataframe(scrobbles)
 
-    return pd.DataFrame(list_response)
+def similar_artists_matches(response: requests.Response) -> list[tuple[str, str, float]]:
+    "Return the name, url and match score of the similar artists in an artist.getSimilar response."
+
+    return [
+        (artist.get("name"), artist.get("url"), float(artist.get("match")))
+        for artist in response.json().get("similarartists").get("artist")
+        if float(artist.get("match")) > SIMILAR_ARTIST_MIN_MATCH
+    ]
 
 def similar_artists(artist_name: str) -> set[tuple[str, str]]:
     "Return a set of similar artists based on a given artist name."
 
-    params = {
-        "method": "artist.getSimilar",
-        "artist": artist_name,
-        "api_key": LASTFM_API_KEY,
-        "format": "json"
-    }
-
-    response = requests.get(ROOT_URL, params=params, timeout=REQUEST_TIMEOUT)
+    response = lastfm_client.get("artist.getSimilar", {"artist": artist_name})
 
     if not lastfm_validation.check_lastfm_response(response):
         return set()
 
-    response_json = response.json()
-
-    similar_artists_set = (
-        (artist.get("name"), artist.get("url"))
-        for artist in response_json.get("similarartists").get("artist")
-        if float(artist.get("match")) > 0.7
-    )
+    return {(name, url) for name, url, _ in similar_artists_matches(response)}
 
-    return set(similar_artists_set)
-
-def all_similar_artists(artists: pd.Series, top_artist_limit: int=10) -> pd.DataFrame:
+def all_similar_artists(
+        artists: pd.Series,
+        top_artist_limit: int=10,
+        depth: int=1,
+        max_workers: int=MAX_WORKERS
+    ) -> pd.DataFrame:
     """Returns the top similar artists based on Last.fm data
         given the top top_artist_limit most listened to artist during
         a particular time period.
-    """
-    similar_artists_set = set()
 
-    for artist in artists.head(top_artist_limit):
-        similar = similar_artists(artist)
-        similar_artists_set.update(similar)
+    Artists are ranked by the sum of their match scores. With depth > 1 the
+    best top_artist_limit artists found on one level are expanded again and
+    their matches are weighted by their own score.
 
-    similar_artists_distinct = [
-        (name, url)
-        for name, url in similar_artists_set
-        if name.lower() not in list(map(lambda artist: artist.lower(), artists))
-    ]
+    Keyword arguments:
+    - artists -- the listened to artists, most listened to first
+    - top_artist_limit (optional) -- how many artists to expand on each level
+    - depth (optional) -- how many levels of similar artists to expand
+    - max_workers (optional) -- upper bound of concurrent requests
+    """
 
-    return pd.DataFrame(similar_artists_distinct, columns=["name", "url"])
+    listened_artists = {artist.lower() for artist in artists}
+    expanded_artists = set()
+    found_artists: dict[str, dict] = {}
+
+    level = [(artist, 1.0) for artist in artists.head(top_artist_limit)]
+
+    for _ in range(depth):
+        expanded_artists.update(artist.lower() for artist, _ in level)
+        responses = fetch_all(
+            lambda artist: lastfm_client.get("artist.getSimilar", {"artist": artist}),
+            [artist for artist, _ in level],
+            max_workers
+        )
+
+        for (_, weight), response in zip(level, responses):
+            if not lastfm_validation.check_lastfm_response(response):
+                continue
+
+            for name, url, match in similar_artists_matches(response):
+                if name.lower() in listened_artists:
+                    continue
+
+                found = found_artists.setdefault(
+                    name.lower(),
+                    {"name": name, "url": url, "match": 0.0}
+                )
+                found["match"] += weight * match
+
+        level = sorted(
+            (
+                (found["name"], found["match"])
+                for key, found in found_artists.items()
+                if key not in expanded_artists
+            ),
+            key=lambda artist: artist[1],
+            reverse=True
+        )[:top_artist_limit]
+
+    return pd.DataFrame(
+        sorted(found_artists.values(), key=lambda artist: artist["match"], reverse=True),
+        columns=["name", "url", "match"]
+    )
 
 def duration(name: str, artist: str) -> int:
     "Gets duration by track name and artist from Last.fm in milliseconds"
 
-    params = {
-        "method": "track.getInfo",
-        "track": name,
-        "artist": artist,
-        "api_key": LASTFM_API_KEY,
-        "format": "json"
-    }
-
-    response = requests.get(ROOT_URL, params=params, timeout=REQUEST_TIMEOUT)
+    response = lastfm_client.get("track.getInfo", {"track": name, "artist": artist})
 
     if not lastfm_validation.check_lastfm_response(response):
         return 0
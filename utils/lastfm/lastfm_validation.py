@@ -3,15 +3,12 @@
     depend on the chosen time period.
 """
 
-import os
 from datetime import date
 
 import requests
-from flask import flash
+from flask import flash, g, has_app_context
 
-REQUEST_TIMEOUT = 600
-LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
-ROOT_URL = "http://ws.audioscrobbler.com/2.0/"
+from utils.lastfm.client import lastfm_client
 
 def check_lastfm_response(response: requests.Response) -> bool:
     "Checks if a response from Last.fm is valid."
@@ -27,31 +24,32 @@ def check_lastfm_response(response: requests.Response) -> bool:
 
     return True
 
-def check_if_user_exists(username: str) -> bool:
-    "Send a request to the Last.fm API checking if a user exists."
+def get_user_info(username: str) -> requests.Response:
+    """Return the user.getinfo response of a user.
+    The response is memoized for the current request, so checking
+    if the user exists and getting their registration date
+    costs a single call to Last.fm.
+    """
+
+    if not has_app_context():
+        return lastfm_client.get("user.getinfo", {"user": username})
+
+    user_info = g.setdefault("lastfm_user_info", {})
 
-    params = {
-        "method": "user.getinfo",
-        "user": username,
-        "api_key": LASTFM_API_KEY,
-        "format": "json"
-    }
+    if username.lower() not in user_info:
+        user_info[username.lower()] = lastfm_client.get("user.getinfo", {"user": username})
 
-    response = requests.get(ROOT_URL, params=params, timeout=REQUEST_TIMEOUT)
+    return user_info[username.lower()]
 
-    return response.ok
+def check_if_user_exists(username: str) -> bool:
+    "Send a request to the Last.fm API checking if a user exists."
+
+    return get_user_info(username).ok
 
 def get_registration_date(username: str) -> date:
     "Get the registration date of a user by username."
 
-    params = {
-        "method": "user.getinfo",
-        "user": username,
-        "api_key": LASTFM_API_KEY,
-        "format": "json"
-    }
-
-    response = requests.get(ROOT_URL, params=params, timeout=REQUEST_TIMEOUT)
+    response = get_user_info(username)
 
     if not check_lastfm_response(response):
         return date.today()
@@ -0,0 +1,203 @@
+"""
+    A local SQLite store of Last.fm scrobbles per user.
+    Every user has a list of synced time intervals - only the parts
+    of a requested time range outside of them are fetched from Last.fm,
+    everything else is answered from the store.
+
+    Last.fm timestamps a scrobble with the time the track started and
+    clients can submit scrobbles late (e.g. offline mobile scrobbles),
+    so the last LATE_SCROBBLE_WINDOW seconds are never marked as synced
+    and are fetched again by every sync.
+"""
+
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import pandas as pd
+
+from utils.lastfm import get_data
+
+STORE_PATH = os.getenv(
+    "SCROBBLE_STORE_PATH",
+    os.path.join(os.getcwd(), "scrobble_store.sqlite3")
+)
+LATE_SCROBBLE_WINDOW = int(os.getenv("SCROBBLE_STORE_LATE_WINDOW", str(14 * 24 * 60 * 60)))
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS scrobbles (
+        username TEXT NOT NULL,
+        uts INTEGER NOT NULL,
+        track TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        album TEXT NOT NULL,
+        PRIMARY KEY (username, uts, track, artist)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS synced_intervals (
+        username TEXT NOT NULL,
+        oldest_uts INTEGER NOT NULL,
+        newest_uts INTEGER NOT NULL,
+        PRIMARY KEY (username, oldest_uts)
+    ) WITHOUT ROWID;
+"""
+
+def connect() -> sqlite3.Connection:
+    "Open a connection to the store and create the tables if needed."
+    connection = sqlite3.connect(STORE_PATH, timeout=30)
+    connection.executescript(SCHEMA)
+
+    return connection
+
+def synced_intervals(connection: sqlite3.Connection, username: str) -> list[tuple[int, int]]:
+    "Return the synced intervals of a user as (oldest, newest) unix timestamps, oldest first."
+    return connection.execute(
+        """SELECT oldest_uts, newest_uts FROM synced_intervals
+        WHERE username = ? ORDER BY oldest_uts""",
+        (username.lower(),)
+    ).fetchall()
+
+def missing_ranges(
+        synced: list[tuple[int, int]],
+        start_timestamp: int,
+        end_timestamp: int
+    ) -> list[tuple[int, int]]:
+    """Return the parts of start_timestamp - end_timestamp
+    which are not covered by the synced intervals.
+    """
+
+    ranges = []
+
+    for oldest, newest in sorted(synced):
+        if newest < start_timestamp:
+            continue
+        if oldest > end_timestamp:
+            break
+
+        if oldest > start_timestamp:
+            ranges.append((start_timestamp, oldest - 1))
+
+        start_timestamp = max(start_timestamp, newest + 1)
+
+    if start_timestamp <= end_timestamp:
+        ranges.append((start_timestamp, end_timestamp))
+
+    return ranges
+
+def mark_synced(
+        connection: sqlite3.Connection,
+        username: str,
+        start_timestamp: int,
+        end_timestamp: int
+    ) -> None:
+    "Add an interval to the synced intervals of a user, merged with the ones it overlaps or touches."
+
+    if start_timestamp > end_timestamp:
+        return
+
+    condition = "username = ? AND oldest_uts <= ? AND newest_uts >= ?"
+    parameters = (username.lower(), end_timestamp + 1, start_timestamp - 1)
+
+    for oldest, newest in connection.execute(
+            f"SELECT oldest_uts, newest_uts FROM synced_intervals WHERE {condition}",
+            parameters
+        ):
+        start_timestamp = min(start_timestamp, oldest)
+        end_timestamp = max(end_timestamp, newest)
+
+    connection.execute(f"DELETE FROM synced_intervals WHERE {condition}", parameters)
+    connection.execute(
+        "INSERT INTO synced_intervals (username, oldest_uts, newest_uts) VALUES (?, ?, ?)",
+        (username.lower(), start_timestamp, end_timestamp)
+    )
+
+def sync_scrobbles(
+        username: str,
+        start_timestamp: int,
+        end_timestamp: int,
+        progress: get_data.Progress | None=None
+    ) -> bool:
+    """Fetch the scrobbles of a user which are not in the store yet.
+    Returns False if Last.fm returned an error.
+    The progress (optional) is called with the fetched and total pages of every missing range.
+    """
+
+    now = int(time.time())
+    end_timestamp = min(end_timestamp, now)
+    # late scrobbles can still come in for this time, so it's fetched again every time
+    synced_until = now - LATE_SCROBBLE_WINDOW
+
+    with closing(connect()) as connection:
+        ranges = missing_ranges(
+            synced_intervals(connection, username),
+            start_timestamp,
+            end_timestamp
+        )
+
+        for range_start, range_end in ranges:
+            scrobbles = get_data.recent_scrobbles(username, range_start, range_end, progress=progress)
+
+            if scrobbles is None:
+                return False
+
+            with connection:
+                connection.executemany(
+                    """INSERT OR IGNORE INTO scrobbles (username, uts, track, artist, album)
+                    VALUES (?, ?, ?, ?, ?)""",
+                    [
+                        (
+                            username.lower(),
+                            scrobble["uts"],
+                            scrobble["track"],
+                            scrobble["artist"],
+                            scrobble["album"]
+                        )
+                        for scrobble in scrobbles
+                    ]
+                )
+                mark_synced(connection, username, range_start, min(range_end, synced_until))
+
+    return True
+
+def stored_scrobbles(username: str, start_timestamp: int, end_timestamp: int) -> list[dict]:
+    "Return the stored scrobbles of a user in a time range (newest first)."
+
+    with closing(connect()) as connection:
+        connection.row_factory = sqlite3.Row
+        rows = connection.execute(
+            """SELECT uts, track, artist, album FROM scrobbles
+            WHERE username = ? AND uts BETWEEN ? AND ?
+            ORDER BY uts DESC""",
+            (username.lower(), start_timestamp, end_timestamp)
+        ).fetchall()
+
+    return [dict(row) for row in rows]
+
+def recent_tracks_by_custom_dates(
+        username: str,
+        start_date: str,
+        end_date: str,
+        progress: get_data.Progress | None=None
+    ) -> pd.DataFrame:
+    """Same as get_data.recent_tracks_by_custom_dates, but only
+    the scrobbles which are not in the store yet are fetched.
+
+    Keyword arguments:
+    - username -- Last.fm username
+    - start_date -- start date
+    - end_date -- end_date
+    - progress (optional) -- called with the fetched and total pages
+    """
+
+    start_timestamp, end_timestamp = get_data.custom_dates_to_timestamps(start_date, end_date)
+
+    if not sync_scrobbles(username, start_timestamp, end_timestamp, progress):
+        return pd.DataFrame()
+
+    scrobbles = stored_scrobbles(username, start_timestamp, end_timestamp)
+
+    if not scrobbles:
+        return pd.DataFrame()
+
+    return get_data.scrobbles_to_dataframe(scrobbles)
@@ -0,0 +1,125 @@
+"""
+    Rate limiting and retrying of calls to the Last.fm and Spotify APIs.
+    - TokenBucket - limits the calls per second, shared by all threads
+    and asyncio tasks using the same bucket, and pauses all of them
+    when the API answers that the calls are rate limited
+    - backoff_delay - how long to wait before retrying a rate limited call
+"""
+
+import time
+import random
+import asyncio
+import threading
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 60.0
+
+class TokenBucket:
+    """Allows rate calls per second on average
+    with bursts of up to capacity calls.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        "Take a token and return how many seconds to wait before using it."
+        with self.lock:
+            now = time.monotonic()
+            # during a pause updated_at is its end, the tokens are refilled from then on
+            start = max(now, self.updated_at)
+            self.tokens = min(self.capacity, self.tokens + (start - self.updated_at) * self.rate)
+            self.updated_at = start
+            self.tokens -= 1
+
+            return start - now + max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back every call for the given number of seconds, e.g. after the API
+        answered with Retry-After. The calls are paced again after the pause,
+        without a burst of the tokens which would have been refilled.
+        """
+        with self.lock:
+            resume_at = time.monotonic() + seconds
+
+            if resume_at <= self.paused_until:
+                return
+
+            self.paused_until = resume_at
+            self.tokens = min(self.tokens, 0.0)
+            self.updated_at = max(self.updated_at, resume_at)
+
+    def remaining_pause(self) -> float:
+        "Return how many seconds are left of the current pause."
+        with self.lock:
+            return max(0.0, self.paused_until - time.monotonic())
+
+    def refund(self) -> None:
+        "Give back a token which was taken but not used for a call."
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def acquire(self) -> None:
+        "Block the current thread until a call is allowed."
+        wait_time = self.reserve()
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+        # the bucket could have been paused while this call was waiting
+        while (wait_time := self.remaining_pause()) > 0:
+            time.sleep(wait_time)
+
+    async def acquire_async(self) -> None:
+        "Wait without blocking the event loop until a call is allowed."
+        wait_time = self.reserve()
+
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+        while (wait_time := self.remaining_pause()) > 0:
+            await asyncio.sleep(wait_time)
+
+def retry_after_seconds(headers: Mapping[str, str] | None) -> float | None:
+    "Parse the Retry-After header - either seconds or an HTTP date."
+
+    value = (headers or {}).get("Retry-After")
+
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def backoff_delay(attempt: int, retry_after: float | None=None) -> float:
+    """Return how many seconds to wait before the next attempt.
+    Uses Retry-After if the API sent it, otherwise exponential
+    backoff with full jitter so that waiting threads don't retry together.
+
+    Keyword arguments:
+    - attempt -- the number of the failed attempt, starting from 0
+    - retry_after (optional) -- the parsed Retry-After header
+    """
+
+    if retry_after is not None:
+        return retry_after + random.uniform(0, BACKOFF_BASE)
+
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
@@ -0,0 +1,165 @@
+"""
+    A server side store of the aggregated results of an analysis
+    keyed by an analysis id, so the session only has to carry the id.
+    The results are kept as msgpack and every view renders its tables
+    and graphs from them when it is requested.
+    - FileResultStore - one file per result in a local folder
+    - RedisResultStore - shared between all workers using the same Redis server
+"""
+
+import os
+import re
+import time
+import uuid
+import threading
+
+import msgspec
+import redis
+
+from utils.cache import REDIS_URL, evict_least_recently_used
+
+RESULT_STORE_BACKEND = os.getenv("RESULT_STORE_BACKEND", "file")
+RESULT_STORE_DIR = os.getenv(
+    "RESULT_STORE_DIR",
+    os.path.join(os.getcwd(), "result_store")
+)
+RESULT_STORE_MAX_BYTES = int(os.getenv("RESULT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+# results which weren't viewed for this many seconds are removed
+RESULT_STORE_MAX_AGE = int(os.getenv("RESULT_STORE_MAX_AGE", str(24 * 60 * 60)))
+
+ANALYSIS_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+def new_analysis_id() -> str:
+    return uuid.uuid4().hex
+
+def valid_analysis_id(analysis_id: str | None) -> bool:
+    "Checks if an id could have been made by new_analysis_id."
+    return bool(analysis_id and ANALYSIS_ID_PATTERN.match(analysis_id))
+
+class FileResultStore:
+    """Results saved as files in a folder. The files which weren't read
+    for max_age seconds are removed, and so are the least recently read files
+    once all of them take more than max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+    def path(self, analysis_id: str) -> str:
+        return os.path.join(self.directory, analysis_id + ".msgpack")
+
+    def save(self, result: dict, analysis_id: str | None=None) -> str:
+        "Save a result under a new or the given analysis id and return the id."
+
+        analysis_id = analysis_id or new_analysis_id()
+        os.makedirs(self.directory, exist_ok=True)
+
+        temporary_path = f"{self.path(analysis_id)}.{uuid.uuid4().hex}.tmp"
+
+        with open(temporary_path, "wb") as result_file:
+            result_file.write(msgspec.msgpack.encode(result))
+
+        os.replace(temporary_path, self.path(analysis_id))
+        self.evict()
+
+        return analysis_id
+
+    def load(self, analysis_id: str | None) -> dict | None:
+        "Return the result of an analysis or None if it is missing or expired."
+
+        if not valid_analysis_id(analysis_id):
+            return None
+
+        path = self.path(analysis_id)
+
+        try:
+            if os.path.getmtime(path) < time.time() - self.max_age:
+                return None
+
+            with open(path, "rb") as result_file:
+                result = msgspec.msgpack.decode(result_file.read())
+
+            # the modification time of a result is its last use
+            os.utime(path)
+        except (OSError, msgspec.DecodeError):
+            return None
+
+        return result
+
+    def evict(self) -> None:
+        "Remove the expired results and then the least recently used ones over the size limit."
+
+        with self.lock:
+            evict_least_recently_used(
+                self.directory,
+                self.max_bytes,
+                self.max_age,
+                # results which are being written end with .tmp
+                is_entry=lambda entry: entry.name.endswith(".msgpack")
+            )
+
+class RedisResultStore:
+    """Results saved in Redis so every worker can render them.
+    A result expires max_age seconds after it was last read,
+    the size is bounded by the maxmemory policy of the Redis server.
+    """
+
+    def __init__(self, url: str, max_age: float, prefix: str="music-analyzer:result:"):
+        self.redis = redis.Redis.from_url(url)
+        self.max_age = max(1, int(max_age))
+        self.prefix = prefix
+
+    def save(self, result: dict, analysis_id: str | None=None) -> str:
+        "Save a result under a new or the given analysis id and return the id."
+
+        analysis_id = analysis_id or new_analysis_id()
+        self.redis.set(self.prefix + analysis_id, msgspec.msgpack.encode(result), ex=self.max_age)
+
+        return analysis_id
+
+    def load(self, analysis_id: str | None) -> dict | None:
+        "Return the result of an analysis or None if it is missing or expired."
+
+        if not valid_analysis_id(analysis_id):
+            return None
+
+        try:
+            value = self.redis.getex(self.prefix + analysis_id, ex=self.max_age)
+        except redis.RedisError:
+            return None
+
+        return None if value is None else msgspec.msgpack.decode(value)
+
+def create_result_store(
+        backend: str,
+        directory: str,
+        max_bytes: int,
+        max_age: float,
+        redis_url: str
+    ) -> FileResultStore | RedisResultStore:
+    """Return a result store for the given backend name.
+
+    Keyword arguments:
+    - backend -- file | redis
+    - directory -- the folder of the file backend
+    - max_bytes -- size limit of the file backend
+    - max_age -- seconds after which an unused result is removed
+    - redis_url -- url of the Redis server for the redis backend
+    """
+
+    match backend:
+        case "redis":
+            return RedisResultStore(redis_url, max_age)
+        case _:
+            return FileResultStore(directory, max_bytes, max_age)
+
+result_store = create_result_store(
+    RESULT_STORE_BACKEND,
+    RESULT_STORE_DIR,
+    RESULT_STORE_MAX_BYTES,
+    RESULT_STORE_MAX_AGE,
+    REDIS_URL
+)
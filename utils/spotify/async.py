@@ -1,25 +1,81 @@
 """
     Asynchronous functions which collect
     Spotify data using spotipy and Spotify's API.
+
+    All coroutines running on the same event loop share one semaphore,
+    so at most SEMAPHORE_NUMBER Spotify calls are in flight at once.
+    The pace of the calls is set by the rate limiter in non_async, which
+    coroutines wait on without blocking the event loop or a worker thread.
 """
 
+import os
 import asyncio
+import weakref
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
 from utils.spotify import non_async
 
-WAIT_TIME = 0.5
-SEMAPHORE_NUMBER = 3
+SEMAPHORE_NUMBER = int(os.getenv("SPOTIFY_CONCURRENCY", "8"))
+URIS_PER_CALL = 50
 
-async def get_artist_uri_async(artist_name: str) -> tuple[str, str | None]:
-    "Asynchronous version of get_artist_uri."
+# the semaphore and the threads which run the blocking spotipy calls of every event loop
+_limits: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop,
+    tuple[asyncio.Semaphore, ThreadPoolExecutor]
+] = weakref.WeakKeyDictionary()
+
+def set_concurrency(concurrency: int) -> None:
+    "Set how many Spotify calls can be in flight at once on the running event loop."
+
+    _limits[asyncio.get_running_loop()] = (
+        asyncio.Semaphore(concurrency),
+        ThreadPoolExecutor(max_workers=concurrency)
+    )
+
+def run_with_reserved_token(function, *args):
+    """Run a Spotify function whose first call uses the token taken by run_limited.
+    The token is given back if the function didn't call Spotify (e.g. a cached uri).
+    """
+
+    non_async.token_reserved.set(True)
+
+    try:
+        return function(*args)
+    finally:
+        if non_async.token_reserved.get():
+            non_async.rate_limiter.refund()
+
+async def run_limited(function, *args):
+    """Run a blocking Spotify function in a thread once the shared semaphore
+    and the rate limiter allow it.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    if loop not in _limits:
+        set_concurrency(SEMAPHORE_NUMBER)
 
-    semaphore = asyncio.Semaphore(SEMAPHORE_NUMBER)
+    semaphore, executor = _limits[loop]
 
     async with semaphore:
-        artist_uri = await asyncio.to_thread(non_async.get_artist_uri, artist_name)
-        await asyncio.sleep(WAIT_TIME)
+        await non_async.rate_limiter.acquire_async()
+
+        # every call runs in a copy of the context, so the reserved token stays with it
+        return await loop.run_in_executor(executor, functools.partial(
+            contextvars.copy_context().run,
+            run_with_reserved_token,
+            function,
+            *args
+        ))
+
+async def get_artist_uri_async(artist_name: str) -> tuple[str, str | None]:
+    "Asynchronous version of get_artist_uri."
+
+    artist_uri = await run_limited(non_async.get_artist_uri, artist_name)
 
     return (artist_name, artist_uri)
 
@@ -30,57 +86,48 @@ async def get_track_or_album_uri_async(
         ) -> tuple[str, str, str | None]:
     "Asynchronous version of get_track_or_album_uri."
 
-    semaphore = asyncio.Semaphore(SEMAPHORE_NUMBER)
-
-    async with semaphore:
-        uri = await asyncio.to_thread(non_async.get_track_or_album_uri, data_type, name, artist)
-        await asyncio.sleep(WAIT_TIME)
+    uri = await run_limited(non_async.get_track_or_album_uri, data_type, name, artist)
 
     return (name, artist, uri)
 
+def split_uris(uris: list[str | None]) -> list[list[str | None]]:
+    "Split a list of uri codes into lists which fit into one Spotify call."
+
+    return [
+        uris[i : i + URIS_PER_CALL]
+        for i in range(0, len(uris), URIS_PER_CALL)
+    ]
+
 async def get_spotify_track_data_by_lastfm_data(lastm_data: pd.DataFrame) \
 -> tuple[pd.DataFrame, list[tuple[str, str]]]:
     """For each track from a dataframe with Last.fm data return its Spotify data
 
     Keyword arguments:
     - lastfm_data -- dataframe with the data from Last.fm
-    Return: A tuple of the dataframe with Spotify track data 
+    Return: A tuple of the dataframe with Spotify track data
     and a list of the names and artists which were not found
     """
 
-    semaphore = asyncio.Semaphore(SEMAPHORE_NUMBER)
-    uri_not_found: list[tuple[str, str]] = []
-
-    async with semaphore:
-        tasks = [
-            get_track_or_album_uri_async("track", row["name"], row["artist"])
-            for _, row in lastm_data.iterrows()
-        ]
-
-        tracks_names_and_uris = await asyncio.gather(*tasks)
-        await asyncio.sleep(WAIT_TIME)
-
-        for name, artist, uri in tracks_names_and_uris:
-            if uri is None:
-                uri_not_found.append((name, artist))
+    tracks_names_and_uris = await asyncio.gather(*[
+        get_track_or_album_uri_async("track", row["name"], row["artist"])
+        for _, row in lastm_data.iterrows()
+    ])
 
-        tracks_uris = [
-            uri
-            for _, _, uri in tracks_names_and_uris
-        ]
-
-        tracks_uris_split = [
-            tracks_uris[i : i + 50]
-            for i in range(0, len(tracks_uris), 50)
-        ]
+    uri_not_found = [
+        (name, artist)
+        for name, artist, uri in tracks_names_and_uris
+        if uri is None
+    ]
 
-        tasks_data = [
-            get_data_async("tracks", uri_sublist)
-            for uri_sublist in tracks_uris_split
-        ]
+    tracks_uris = [
+        uri
+        for _, _, uri in tracks_names_and_uris
+    ]
 
-        tracks_data = await asyncio.gather(*tasks_data)
-        await asyncio.sleep(WAIT_TIME)
+    tracks_data = await asyncio.gather(*[
+        get_data_async("tracks", uri_sublist)
+        for uri_sublist in split_uris(tracks_uris)
+    ])
 
     tracks_dataframe = pd.concat(tracks_data)
 
@@ -97,47 +144,30 @@ async def get_spotify_artist_data_by_lastfm_data(lastfm_data: pd.DataFrame) \
 
     Keyword arguments:
     - lastfm_data -- dataframe with data from Last.fm
-    Return: A tuple of the dataframe with Spotify artist data 
+    Return: A tuple of the dataframe with Spotify artist data
     and a list of the names of artists which were not found
     """
 
-    semaphore = asyncio.Semaphore(SEMAPHORE_NUMBER)
-
-    async with semaphore:
-        tasks = [
-            get_artist_uri_async(row["name"])
-            for _, row in lastfm_data.iterrows()
-        ]
-
-        tracks_artists_and_uris = await asyncio.gather(*tasks)
-        await asyncio.sleep(WAIT_TIME)
-
-        uri_not_found: list[str] = []
-        tracks_uris: list[str | None] = []
-
-        for artist, uri in tracks_artists_and_uris:
-            if uri is None:
-                uri_not_found.append(artist)
-            else:
-                tracks_uris.append(uri)
+    artists_and_uris = await asyncio.gather(*[
+        get_artist_uri_async(row["name"])
+        for _, row in lastfm_data.iterrows()
+    ])
 
-        tracks_uris = [
-            uri
-            for _, uri in tracks_artists_and_uris
-        ]
-
-        tracks_uris_split = [
-            tracks_uris[i : i + 50]
-            for i in range(0, len(tracks_uris), 50)
-        ]
+    uri_not_found = [
+        artist
+        for artist, uri in artists_and_uris
+        if uri is None
+    ]
 
-        tasks_data = [
-            get_data_async("artists", uri_sublist)
-            for uri_sublist in tracks_uris_split
-        ]
+    artists_uris = [
+        uri
+        for _, uri in artists_and_uris
+    ]
 
-        artists_data = await asyncio.gather(*tasks_data)
-        await asyncio.sleep(WAIT_TIME)
+    artists_data = await asyncio.gather(*[
+        get_data_async("artists", uri_sublist)
+        for uri_sublist in split_uris(artists_uris)
+    ])
 
     artists_spotify = pd.concat(artists_data)
     merged = lastfm_data.merge(artists_spotify[["name", "popularity"]], on="name", how="left")
@@ -146,7 +176,7 @@ async def get_spotify_artist_data_by_lastfm_data(lastfm_data: pd.DataFrame) \
 
 async def get_data_async(data_type: str, uri_list: list[str | None]) -> pd.DataFrame:
     """Takes a list of uri codes and returns a dataframe with their data.
-    
+
     Keyword arguments:
     - data_type -- tracks | albums | artists
     - uri_list -- list of uri codes
@@ -157,15 +187,19 @@ async def get_data_async(data_type: str, uri_list: list[str | None]) -> pd.DataF
         "artists": non_async.get_artists_data, "albums": non_async.get_albums_data
         }
 
-    semaphore = asyncio.Semaphore(5)
+    return await run_limited(data_function[data_type], uri_list)
 
-    async with semaphore:
-        result = await asyncio.to_thread(data_function[data_type], uri_list)
-        await asyncio.sleep(WAIT_TIME)
-    return result
+async def collect_data(tracks_data, artists_data, concurrency: int | None=None):
+    """Collect both tracks and artists data asynchronously
+
+    Keyword arguments:
+    - tracks_data -- dataframe with the top tracks from Last.fm
+    - artists_data -- dataframe with the top artists from Last.fm
+    - concurrency (optional) -- how many Spotify calls can be in flight at once,
+    SEMAPHORE_NUMBER by default
+    """
 
-async def collect_data(tracks_data, artists_data):
-    "Collect both tracks and artists data asynchronously"
+    set_concurrency(concurrency or SEMAPHORE_NUMBER)
 
     tasks = [
         get_spotify_track_data_by_lastfm_data(tracks_data),
@@ -3,11 +3,18 @@
     listening history and write the uri codes into a file
 """
 
+import os
 import json
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 
 from utils.spotify import non_async
 from utils.lastfm import get_data
 
+EXPORT_WORKERS = int(os.getenv("SPOTIFY_EXPORT_WORKERS", "8"))
+PROGRESS_EVERY = 100
+
 def get_all_track_uris(username: str) -> None:
     "Dumps the uri codes of all listened to tracks into a json file"
     all_data = get_data.top_data_predefined_period(username, "tracks", "overall")
@@ -43,3 +50,151 @@ def get_all_artist_uris(username: str) -> None:
 
     with open("all_artists_uris.json", "w", encoding="utf-8") as fd:
         json.dump(line_data, fd, indent=2)
+
+def read_exported(path: str, key_fields: tuple[str, ...]) -> set[tuple]:
+    """Return the keys of the entries already written to a JSONL export.
+    A line cut off by a crash is skipped, so its name is resolved again.
+    """
+
+    if not os.path.exists(path):
+        return set()
+
+    exported = set()
+
+    with open(path, "r", encoding="utf-8") as fd:
+        for line in fd:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            exported.add(tuple(entry[field] for field in key_fields))
+
+    return exported
+
+def export_uris_bulk(
+        path: str,
+        key_fields: tuple[str, ...],
+        keys: list[tuple],
+        resolve: Callable[..., str | None],
+        max_workers: int=EXPORT_WORKERS,
+        progress: get_data.Progress | None=None
+    ) -> None:
+    """Resolve the uri codes of keys concurrently and append every result
+    to a JSONL file as soon as it arrives. Keys already in the file are skipped,
+    so an interrupted export continues where it stopped.
+
+    Keyword arguments:
+    - path -- the JSONL file
+    - key_fields -- the names of the fields of a key, for example ("name", "artist")
+    - keys -- the keys to resolve
+    - resolve -- called with the fields of a key, returns the uri code
+    - max_workers (optional) -- how many names are resolved at once
+    - progress (optional) -- called with the exported and total keys of this run,
+    every PROGRESS_EVERY keys and at the end, e.g. print_progress()
+    """
+
+    exported = read_exported(path, key_fields)
+    remaining = [key for key in dict.fromkeys(keys) if key not in exported]
+    pending = iter(remaining)
+    total = len(remaining)
+
+    # a line cut off by a crash mustn't be joined with the next one
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "rb") as fd:
+            fd.seek(-1, os.SEEK_END)
+            needs_newline = fd.read(1) != b"\n"
+    else:
+        needs_newline = False
+
+    done = 0
+
+    if progress is not None:
+        progress(done, total)
+
+    with open(path, "a", encoding="utf-8") as fd, \
+        ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if needs_newline:
+            fd.write("\n")
+
+        running: dict[Future, tuple] = {}
+
+        while True:
+            # only a few keys wait in the queue so memory doesn't grow with the export
+            while len(running) < max_workers * 2 and (key := next(pending, None)) is not None:
+                running[executor.submit(resolve, *key)] = key
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                key = running.pop(future)
+                entry = dict(zip(key_fields, key))
+                entry["uri"] = future.result()
+
+                fd.write(json.dumps(entry) + "\n")
+                fd.flush()
+
+                done += 1
+
+                if progress is not None and (done % PROGRESS_EVERY == 0 or done == total):
+                    progress(done, total)
+
+def print_progress() -> get_data.Progress:
+    "Return a progress callback which prints the exported keys and the keys per second."
+
+    started_at = time.monotonic()
+
+    def progress(done: int, total: int) -> None:
+        elapsed = max(time.monotonic() - started_at, 1e-9)
+        print(f"{done}/{total} uri codes exported, {done / elapsed:.1f} per second")
+
+    return progress
+
+def export_track_uris_bulk(
+        username: str,
+        path: str="all_tracks_uris.jsonl",
+        max_workers: int=EXPORT_WORKERS,
+        progress: get_data.Progress | None=None
+    ) -> None:
+    "Appends the uri codes of all listened to tracks to a JSONL file, resuming a partial export"
+
+    all_data = get_data.top_data_predefined_period(username, "tracks", "overall")
+
+    export_uris_bulk(
+        path,
+        ("name", "artist"),
+        [
+            (row["name"], row["artist"])
+            for _, row in all_data.iterrows()
+            if row["name"] and row["artist"]
+        ],
+        lambda name, artist: non_async.get_track_or_album_uri("track", name, artist),
+        max_workers,
+        progress
+    )
+
+def export_artist_uris_bulk(
+        username: str,
+        path: str="all_artists_uris.jsonl",
+        max_workers: int=EXPORT_WORKERS,
+        progress: get_data.Progress | None=None
+    ) -> None:
+    "Appends the uri codes of all listened to artists to a JSONL file, resuming a partial export"
+
+    all_data = get_data.top_data_predefined_period(username, "artists", "overall")
+
+    export_uris_bulk(
+        path,
+        ("name",),
+        [
+            (row["name"],)
+            for _, row in all_data.iterrows()
+            if row["name"]
+        ],
+        non_async.get_artist_uri,
+        max_workers,
+        progress
+    )
@@ -2,7 +2,9 @@
     Contains all functions requiring Spotify API calls.
 """
 
+import os
 import re
+from contextvars import ContextVar
 
 import spotipy # type: ignore
 from spotipy.oauth2 import SpotifyClientCredentials # type: ignore
@@ -10,22 +12,67 @@ import dotenv
 import pandas as pd
 
 from utils import validation
+from utils.spotify import uri_cache
+from utils.rate_limit import TokenBucket, MAX_RETRIES, backoff_delay, retry_after_seconds
 
 dotenv.load_dotenv()
 
-auth_manager = SpotifyClientCredentials()
-spotify = spotipy.Spotify(auth_manager=auth_manager)
+RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))
+RATE_LIMIT_BURST = float(os.getenv("SPOTIFY_RATE_LIMIT_BURST", "10"))
 
-WAIT_TIME = 0.5
-SEMAPHORE_NUMBER = 3
+auth_manager = SpotifyClientCredentials()
+# 429 is left out of the retried status codes so that call_spotify can handle it
+spotify = spotipy.Spotify(auth_manager=auth_manager, status_forcelist=(500, 502, 503, 504))
+rate_limiter = TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST)
+# True while a function runs with a token which was already taken
+# from rate_limiter - the async module waits for it on the event loop
+token_reserved: ContextVar[bool] = ContextVar("token_reserved", default=False)
+
+def call_spotify(function, *args, **kwargs):
+    """Call a spotipy function once the rate limit allows it.
+    If Spotify still answers with 429 the call is retried after Retry-After.
+    """
+
+    for attempt in range(MAX_RETRIES + 1):
+        if token_reserved.get():
+            token_reserved.set(False)
+        else:
+            rate_limiter.acquire()
+
+        try:
+            return function(*args, **kwargs)
+        except spotipy.SpotifyException as error:
+            if error.http_status != 429 or attempt == MAX_RETRIES:
+                raise
+
+            # all threads and asyncio tasks wait, not only the one which was refused
+            rate_limiter.pause(backoff_delay(attempt, retry_after_seconds(error.headers)))
+
+    return None
 
 def get_artist_uri(artist_name: str) -> str | None:
+    "Returns the unique uri code of an artist, searching Spotify only if it isn't cached"
+
+    is_cached, artist_uri = uri_cache.cached_uri("artist", artist_name)
+
+    if not is_cached:
+        artist_uri = search_artist_uri(artist_name)
+        uri_cache.store_uri("artist", artist_name, "", artist_uri)
+
+    return artist_uri
+
+def search_artist_uri(artist_name: str) -> str | None:
     "Search an artist by name - returns their unique uri code"
 
     # spotify search doesn't like special symbols
     artist_name_clean = re.sub(r"[^\w\s]", "", artist_name)
     print("Getting " + artist_name_clean)
-    search_results = spotify.search(q=f"artist:{artist_name_clean}", type="artist", limit=50)
+    search_results = call_spotify(
+        spotify.search,
+        q=f"artist:{artist_name_clean}",
+        type="artist",
+        limit=50
+    )
 
     if search_results["artists"]["items"] == []:
         return None
@@ -40,12 +87,27 @@ def get_artist_uri(artist_name: str) -> str | None:
     return None if search_results_filtered == [] else search_results_filtered[0]
 
 def get_track_or_album_uri(data_type: str, name: str, artist: str) -> str | None:
-    "Search an artist by name - returns their unique uri code"
+    "Returns the unique uri code of a track or album, searching Spotify only if it isn't cached"
 
     if not validation.check_spotify_data_type(data_type):
         return None
 
-    search_results = spotify.search(q=f"{data_type}:{name} artist:{artist}", type=data_type)
+    is_cached, uri = uri_cache.cached_uri(data_type, name, artist)
+
+    if not is_cached:
+        uri = search_track_or_album_uri(data_type, name, artist)
+        uri_cache.store_uri(data_type, name, artist, uri)
+
+    return uri
+
+def search_track_or_album_uri(data_type: str, name: str, artist: str) -> str | None:
+    "Search a track or album by name and artist - returns its unique uri code"
+
+    search_results = call_spotify(
+        spotify.search,
+        q=f"{data_type}:{name} artist:{artist}",
+        type=data_type
+    )
 
     if search_results[data_type + "s"]["items"] == []:
         return None
@@ -73,7 +135,7 @@ def get_artists_data(uri_list: list[str | None]) -> pd.DataFrame:
         if uri is not None
     ]
 
-    artists_data = spotify.artists(uri_list)
+    artists_data = call_spotify(spotify.artists, uri_list)
 
     artists_data_clean = [
         {
@@ -96,7 +158,7 @@ def get_tracks_data(uri_list: list[str | None]) -> pd.DataFrame:
         if uri is not None
     ]
 
-    result_data = spotify.tracks(uri_list)
+    result_data = call_spotify(spotify.tracks, uri_list)
 
     search_results_clean = [
                 {
@@ -122,7 +184,7 @@ def get_albums_data(uri_list: list[str | None]) -> pd.DataFrame:
         if uri is not None
     ]
 
-    result_data = spotify.albums(uri_list)
+    result_data = call_spotify(spotify.albums, uri_list)
 
     search_results_clean = [
                 {
@@ -0,0 +1,94 @@
+"""
+    A persistent SQLite cache of Spotify search results,
+    so the same name is searched for only once.
+    Names which weren't found are cached too, but for a shorter time.
+    Every thread keeps its own connection, so the many lookups
+    of a bulk export don't open a connection each.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import threading
+
+CACHE_PATH = os.getenv(
+    "SPOTIFY_URI_CACHE_PATH",
+    os.path.join(os.getcwd(), "spotify_uri_cache.sqlite3")
+)
+
+DAY = 24 * 60 * 60
+FOUND_TTL = float(os.getenv("SPOTIFY_URI_CACHE_TTL", str(90 * DAY)))
+NOT_FOUND_TTL = float(os.getenv("SPOTIFY_URI_CACHE_NOT_FOUND_TTL", str(7 * DAY)))
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS uris (
+        data_type TEXT NOT NULL,
+        name TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        uri TEXT,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (data_type, name, artist)
+    ) WITHOUT ROWID;
+"""
+
+def normalize(name: str) -> str:
+    "Normalize a name so different spellings of the same name share a cache entry."
+    return re.sub(r"\s+", " ", name).strip().casefold()
+
+# cache path -> connection of the current thread
+_connections = threading.local()
+# the cache files whose table was created by this process
+_created_schemas: set[str] = set()
+_schema_lock = threading.Lock()
+
+def connect() -> sqlite3.Connection:
+    "Return the connection of the current thread to the cache, the table is created once."
+
+    connections = _connections.__dict__.setdefault("by_path", {})
+    connection = connections.get(CACHE_PATH)
+
+    if connection is None:
+        connection = sqlite3.connect(CACHE_PATH, timeout=30)
+
+        with _schema_lock:
+            if CACHE_PATH not in _created_schemas:
+                connection.execute(SCHEMA)
+                _created_schemas.add(CACHE_PATH)
+
+        connections[CACHE_PATH] = connection
+
+    return connection
+
+def cached_uri(data_type: str, name: str, artist: str="") -> tuple[bool, str | None]:
+    """Look up a search result.
+    Returns if a fresh entry exists and the uri (None if it wasn't found on Spotify).
+
+    Keyword arguments:
+    - data_type -- artist | track | album
+    - name -- the name of the artist, track or album
+    - artist (optional) -- the artist of the track or album
+    """
+
+    row = connect().execute(
+        """SELECT uri FROM uris
+        WHERE data_type = ? AND name = ? AND artist = ? AND expires_at > ?""",
+        (data_type, normalize(name), normalize(artist), time.time())
+    ).fetchone()
+
+    if row is None:
+        return False, None
+
+    return True, row[0]
+
+def store_uri(data_type: str, name: str, artist: str, uri: str | None) -> None:
+    "Store a search result - uri is None if nothing was found."
+
+    ttl = NOT_FOUND_TTL if uri is None else FOUND_TTL
+
+    with connect() as connection:
+        connection.execute(
+            """INSERT OR REPLACE INTO uris (data_type, name, artist, uri, expires_at)
+            VALUES (?, ?, ?, ?, ?)""",
+            (data_type, normalize(name), normalize(artist), uri, time.time() + ttl)
+        )
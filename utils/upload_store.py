@@ -0,0 +1,59 @@
+"""
+    Uploaded history files spooled to the disk, so the request which receives
+    them and the job which parses them never hold a whole upload in memory.
+    The job gets the paths of the files and removes them once it is done.
+
+    With JOB_BACKEND=redis the jobs run in other processes, so UPLOAD_DIR
+    has to be a folder shared by the web server and the job workers.
+"""
+
+import os
+import time
+import uuid
+
+UPLOAD_DIR = os.getenv(
+    "SPOTIFY_UPLOAD_DIR",
+    os.path.join(os.getcwd(), "uploads")
+)
+# uploads whose job never ran are removed after this many seconds
+UPLOAD_MAX_AGE = int(os.getenv("SPOTIFY_UPLOAD_MAX_AGE", str(24 * 60 * 60)))
+
+def save_uploads(files: list) -> list[tuple[str, str]]:
+    """Stream uploaded files to the upload folder.
+    Return the original name and the saved path of every file.
+    """
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    remove_old_uploads()
+
+    uploads = []
+
+    for file in files:
+        # the saved name doesn't depend on the user, only the extension is kept
+        extension = os.path.splitext(file.filename or "")[1].lower()
+        path = os.path.join(UPLOAD_DIR, uuid.uuid4().hex + extension)
+        file.save(path)
+        uploads.append((file.filename, path))
+
+    return uploads
+
+def remove_uploads(uploads: list[tuple[str, str]]) -> None:
+    "Remove the saved files of uploads which were parsed."
+
+    for _, path in uploads:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def remove_old_uploads(max_age: float | None=None) -> None:
+    "Remove the saved uploads which are older than max_age seconds (UPLOAD_MAX_AGE by default)."
+
+    oldest_allowed = time.time() - (UPLOAD_MAX_AGE if max_age is None else max_age)
+
+    for entry in os.scandir(UPLOAD_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < oldest_allowed:
+                os.remove(entry.path)
+        except OSError:
+            continue
@@ -84,9 +84,9 @@ def valid_date_intervals(username: str, start_date: str, end_date: str):
 
     return True
 
-def is_file_extension_json(filename: str) -> bool:
-    "Checks the file extension of a file given its filename."
-    if not ('.' in filename and filename.rsplit('.', 1)[-1].lower() == "json"):
+def is_history_file_extension(filename: str) -> bool:
+    "Checks if an uploaded Spotify history file is a .json file or a .zip export."
+    if not ('.' in filename and filename.rsplit('.', 1)[-1].lower() in ["json", "zip"]):
         flash(f"Invalid filename: {filename}")
         return False
 